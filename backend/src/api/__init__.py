@@ -1,16 +1,92 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import asyncio
+import time
+
+# Start of the time to first request, see /health
+imported_at = time.perf_counter()
+
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
-from api.models import Users, init_db
-from api.routes import contests, problems, run
+from api import config, metrics, models
+from api.backplane import backplane
+from api.models import Users, close_db
+from api.routes import (
+    broadcast_standings,
+    contests,
+    handle_messages,
+    jobs,
+    manager,
+    problems,
+    run,
+)
+from api.routes import metrics as metrics_routes
+from api.worker import start_workers, supervise_workers
 
 app = FastAPI()
 app.include_router(run.router)
 app.include_router(contests.router)
 app.include_router(problems.router)
+app.include_router(jobs.router)
+app.include_router(metrics_routes.router)
+
+first_request_ms = None
+
+
+@app.middleware("http")
+async def time_first_request(request: Request, call_next):
+    global first_request_ms
+    response = await call_next(request)
+    if first_request_ms is None:
+        first_request_ms = round((time.perf_counter() - imported_at) * 1000, 1)
+        print(f"Time to first request: {first_request_ms} ms")
+    return response
+
+
+@app.get("/health")
+async def health() -> dict:
+    return {
+        "status": "ok",
+        # From importing the app to the end of the first response
+        "time_to_first_request_ms": first_request_ms,
+        # Schema and seed, done by the first query (None until then)
+        "db_setup_ms": models.setup_ms,
+        "backplane": await backplane.report(),
+        # Open websockets of this process, by contest code
+        "websockets": {
+            code: len(connections)
+            for code, connections in manager.active_connections.items()
+        },
+    }
+
+
+# The database is set up lazily by the first query, not here
+@app.on_event("startup")
+async def start_judge():
+    # Before the judge workers start, they follow the switch
+    metrics.set_tracing(config.TRACE)
+    app.state.judge_workers = start_workers(config.JUDGE_WORKERS)
+    app.state.backplane_tasks = [
+        asyncio.create_task(handle_messages()),
+        asyncio.create_task(broadcast_standings()),
+    ]
+    app.state.supervisor_task = asyncio.create_task(
+        supervise_workers(app.state.judge_workers)
+    )
+    app.state.metrics_task = asyncio.create_task(metrics.write_snapshots())
+
 
-init_db()
+@app.on_event("shutdown")
+async def stop_judge():
+    for task in app.state.backplane_tasks:
+        task.cancel()
+    app.state.metrics_task.cancel()
+    # Not restarted once they are terminated
+    app.state.supervisor_task.cancel()
+    await backplane.close()
+    for process in app.state.judge_workers:
+        process.terminate()
+    await close_db()
 
 origins = [
     "http://localhost",
@@ -32,7 +108,7 @@ class User(BaseModel):
 
 
 @app.post("/user")
-def create_user(user: User) -> Users:
+async def create_user(user: User) -> Users:
     user = Users(username=user.username)
-    user.create()
+    await user.create()
     return user
\ No newline at end of file
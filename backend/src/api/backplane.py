@@ -0,0 +1,155 @@
+"""Messages between processes: judge workers tell every API process what was
+solved, so each can update its websockets and caches, and API processes tell
+each other to drop cached problems and contests.
+
+CODEFORGE_BACKPLANE picks the transport:
+
+- `socket` (default): a unix datagram socket per subscribing process in
+  CODEFORGE_BACKPLANE_DIR, for any number of API and judge processes on one
+  machine
+- `redis://host:6379/0`: Redis pub/sub, for processes on several machines
+  (needs the `redis` extra)
+"""
+
+import asyncio
+import contextlib
+import glob
+import json
+import os
+import socket
+import time
+
+from api import config
+
+CHANNEL = "codeforge"
+
+
+class Backplane:
+    def __init__(self):
+        self.published = 0
+        self.dropped = 0  # messages a subscriber didn't take in time
+        self.received = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    async def publish(self, message: dict):
+        message = {**message, "sent_at": time.time(), "pid": os.getpid()}
+        await self.send(json.dumps(message).encode())
+        self.published += 1
+
+    def received_message(self, data: bytes) -> dict:
+        message = json.loads(data)
+        latency = max(time.time() - message["sent_at"], 0)
+        self.received += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        return message
+
+    async def report(self) -> dict:
+        return {
+            "backend": type(self).__name__,
+            "pid": os.getpid(),
+            "subscribers": await self.subscribers(),
+            "published": self.published,
+            "dropped": self.dropped,
+            "received": self.received,
+            "latency_ms": {
+                "mean": round(self.latency_total / self.received * 1000, 3)
+                if self.received
+                else None,
+                "max": round(self.latency_max * 1000, 3),
+            },
+        }
+
+    async def close(self):
+        pass
+
+
+class SocketBackplane(Backplane):
+    """Subscribers bind <directory>/<pid>.sock, publishers send each message
+    to every socket there."""
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    async def send(self, data: bytes):
+        await asyncio.gather(
+            *(self.send_to(path, data) for path in glob.glob(f"{self.directory}/*.sock"))
+        )
+
+    async def send_to(self, path: str, data: bytes):
+        loop = asyncio.get_running_loop()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            try:
+                sock.connect(path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a process that is gone
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+                return
+            # A connected socket waits while the subscriber's queue is full
+            try:
+                await asyncio.wait_for(
+                    loop.sock_sendall(sock, data), config.BACKPLANE_SEND_TIMEOUT
+                )
+            except (asyncio.TimeoutError, OSError):
+                self.dropped += 1
+
+    async def subscribe(self):
+        loop = asyncio.get_running_loop()
+        path = os.path.join(self.directory, f"{os.getpid()}.sock")
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.bind(path)
+            sock.setblocking(False)
+            try:
+                while True:
+                    yield self.received_message(await loop.sock_recv(sock, 65536))
+            finally:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+
+    async def subscribers(self) -> int:
+        return len(glob.glob(f"{self.directory}/*.sock"))
+
+
+class RedisBackplane(Backplane):
+    def __init__(self, url: str):
+        super().__init__()
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+
+    async def send(self, data: bytes):
+        await self.client.publish(CHANNEL, data)
+
+    async def subscribe(self):
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(CHANNEL)
+        try:
+            async for item in pubsub.listen():
+                if item["type"] == "message":
+                    yield self.received_message(item["data"])
+        finally:
+            await pubsub.aclose()
+
+    async def subscribers(self) -> int:
+        return dict(await self.client.pubsub_numsub(CHANNEL)).get(CHANNEL.encode(), 0)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_backplane(url: str) -> Backplane:
+    if url.startswith(("redis://", "rediss://")):
+        return RedisBackplane(url)
+    if url == "socket":
+        return SocketBackplane(config.BACKPLANE_DIR)
+    raise ValueError(f"Unknown backplane: {url}")
+
+
+backplane = create_backplane(config.BACKPLANE)
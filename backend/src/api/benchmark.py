@@ -0,0 +1,462 @@
+"""Judge throughput benchmark, results as JSON:
+
+    python -m api.benchmark [--output results.json] [--compare baseline.json]
+
+Starts an API server with a fresh database in a temporary directory (or uses
+--url), adds synthetic problems (sum the numbers of the input) and measures
+the scenarios below. --database-url points the server at another (empty)
+database instead, e.g. a local PostgreSQL:
+
+    python -m api.benchmark --database-url postgresql+asyncpg://postgres@localhost/codeforge
+
+- spawn: sandbox and request overhead of an empty program per language
+- run: POST /run latency per language, input size and concurrency
+- submit: POST /problems/{code}/submit until the job is done, per language,
+  number of tests, input size and concurrency: submissions/sec, submission
+  latency and per-test sandbox wall time
+- memory: peak RSS of the API process and its judge workers, when the
+  benchmark started the server
+
+Latencies are reported in milliseconds at p50/p95/p99. With --compare, the
+scenarios that got slower than the baseline by more than --tolerance are
+listed and the exit code is 1.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+SOLUTIONS = {
+    "py": """import sys
+numbers = sys.stdin.buffer.read().split()
+print(sum(map(int, numbers[1:])))
+""",
+    "js": """const numbers = require("fs").readFileSync(0, "utf8").trim().split(/\\s+/);
+let sum = 0;
+for (let i = 1; i < numbers.length; i++) sum += Number(numbers[i]);
+console.log(String(sum));
+""",
+    "c": """#include <stdio.h>
+int main() {
+    long long n, x, sum = 0;
+    scanf("%lld", &n);
+    for (long long i = 0; i < n; i++) {
+        scanf("%lld", &x);
+        sum += x;
+    }
+    printf("%lld\\n", sum);
+    return 0;
+}
+""",
+    "cpp": """#include <iostream>
+int main() {
+    std::ios::sync_with_stdio(false);
+    std::cin.tie(nullptr);
+    long long n, x, sum = 0;
+    std::cin >> n;
+    for (long long i = 0; i < n; i++) {
+        std::cin >> x;
+        sum += x;
+    }
+    std::cout << sum << "\\n";
+    return 0;
+}
+""",
+}
+
+EMPTY_PROGRAMS = {
+    "py": "",
+    "js": "",
+    "c": "int main() { return 0; }\n",
+    "cpp": "int main() { return 0; }\n",
+}
+
+POLL_INTERVAL = 0.05
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    values = sorted(values)
+
+    def at(p):
+        # Nearest rank
+        return round(values[min(len(values) - 1, max(0, round(p * len(values)) - 1))], 3)
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99)}
+
+
+def make_input(size: int, rng: random.Random) -> tuple[str, str]:
+    """About `size` bytes of numbers to sum, and their sum."""
+    numbers = []
+    length = 0
+    while length < size or not numbers:
+        number = rng.randint(0, 999999)
+        numbers.append(number)
+        length += len(str(number)) + 1
+    return f"{len(numbers)}\n{' '.join(map(str, numbers))}\n", str(sum(numbers))
+
+
+def peak_rss_mb(pid: int) -> float | None:
+    """VmHWM of a local process, None when it isn't readable."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+
+
+def child_pids(pid: int) -> list[int]:
+    pids = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    return pids
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(directory: str, port: int, database_url: str | None = None) -> subprocess.Popen:
+    """uvicorn with its database (unless given), test data and caches in
+    `directory`. It runs in the current directory, which has the problems.json
+    it is seeded with."""
+    src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(filter(None, [src, os.environ.get("PYTHONPATH")])),
+        "CODEFORGE_DATABASE_URL": database_url or f"sqlite+aiosqlite:///{directory}/codeforge.db",
+        "CODEFORGE_TESTDATA_DIR": f"{directory}/testdata",
+        "CODEFORGE_COMPILE_CACHE_DIR": f"{directory}/compile_cache",
+        "CODEFORGE_BACKPLANE_DIR": f"{directory}/backplane",
+    }
+    env.pop("CODEFORGE_DB_SNAPSHOT", None)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--port", str(port), "--log-level", "warning"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+async def wait_for_server(client: httpx.AsyncClient, timeout: float = 60) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            response = await client.get("/health")
+            if response.status_code == 200:
+                return response.json()
+        except httpx.TransportError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError("API server didn't start")
+        await asyncio.sleep(0.2)
+
+
+async def run_concurrently(count: int, concurrency: int, task):
+    """Call `await task(i)` for i in range(count), `concurrency` at a time."""
+    indices = iter(range(count))
+
+    async def runner():
+        for i in indices:
+            await task(i)
+
+    await asyncio.gather(*(runner() for _ in range(min(concurrency, count))))
+
+
+async def bench_spawn(client, language: str, requests: int) -> dict:
+    sandbox, overhead = [], []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = await client.post(
+            "/run/", json={"source_code": EMPTY_PROGRAMS[language], "language": language}
+        )
+        elapsed = time.perf_counter() - started
+        wall_time_us = response.json().get("wall_time_us")
+        if wall_time_us is None:
+            continue
+        sandbox.append(wall_time_us / 1000)
+        overhead.append(elapsed * 1000 - wall_time_us / 1000)
+    return {
+        "language": language,
+        "requests": requests,
+        # Spawning the sandbox and the runtime of a program that does nothing
+        "sandbox_ms": percentiles(sandbox),
+        # The rest of the request: compiling, workspace, HTTP
+        "request_ms": percentiles(overhead),
+    }
+
+
+async def bench_run(client, language, input_data, expected, concurrency, requests):
+    latencies, failed = [], 0
+
+    async def task(_):
+        nonlocal failed
+        started = time.perf_counter()
+        response = await client.post(
+            "/run/",
+            json={
+                "source_code": SOLUTIONS[language],
+                "language": language,
+                "input_data": input_data,
+            },
+        )
+        latencies.append((time.perf_counter() - started) * 1000)
+        if response.status_code != 200 or response.json()["stdout"].strip() != expected:
+            failed += 1
+
+    started = time.perf_counter()
+    await run_concurrently(requests, concurrency, task)
+    elapsed = time.perf_counter() - started
+    return {
+        "language": language,
+        "input_bytes": len(input_data),
+        "concurrency": concurrency,
+        "requests": requests,
+        "failed": failed,
+        "requests_per_sec": round(requests / elapsed, 3),
+        "latency_ms": percentiles(latencies),
+    }
+
+
+async def add_problem(client, title: str, tests: int, size: int, rng) -> str:
+    testcases = []
+    for _ in range(tests):
+        input_data, output = make_input(size, rng)
+        testcases.append({"input": input_data, "output": output})
+    response = await client.post(
+        "/problems/",
+        json={
+            "title": title,
+            "difficulty": "Easy",
+            "problem_statement": "Print the sum of the n numbers.",
+            "constraints": f"About {size} bytes of input.",
+            "testcases": testcases,
+            "owner": "admin",
+        },
+    )
+    response.raise_for_status()
+    return response.json()["code"]
+
+
+async def bench_submit(client, code, language, tests, size, concurrency, submissions):
+    latencies, test_latencies = [], []
+    failed = solved = 0
+
+    async def task(_):
+        nonlocal failed, solved
+        started = time.perf_counter()
+        response = await client.post(
+            f"/problems/{code}/submit",
+            json={
+                "source_code": SOLUTIONS[language],
+                "language": language,
+                "username": "admin",
+            },
+        )
+        if response.status_code != 202:
+            failed += 1
+            return
+        job_id = response.json()["id"]
+        while True:
+            job = (await client.get(f"/jobs/{job_id}")).json()
+            if job["status"] in ("done", "failed"):
+                break
+            await asyncio.sleep(POLL_INTERVAL)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if job["status"] == "failed":
+            failed += 1
+            return
+        solved += job["result"]["is_solved"]
+        test_latencies.extend(
+            result["wall_time_us"] / 1000
+            for result in job["result"]["results"]
+            if result["wall_time_us"] is not None
+        )
+
+    started = time.perf_counter()
+    await run_concurrently(submissions, concurrency, task)
+    elapsed = time.perf_counter() - started
+    return {
+        "language": language,
+        "tests": tests,
+        "input_bytes": size,
+        "concurrency": concurrency,
+        "submissions": submissions,
+        "solved": solved,
+        "failed": failed,
+        "submissions_per_sec": round(submissions / elapsed, 3),
+        "submission_latency_ms": percentiles(latencies),
+        # Sandbox wall time of each test
+        "test_latency_ms": percentiles(test_latencies),
+    }
+
+
+async def benchmark(args, url: str, pid: int | None = None) -> dict:
+    """pid is the API server's, when it runs on this machine."""
+    rng = random.Random(args.seed)
+    results = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "url": url,
+        "settings": {
+            "languages": args.languages,
+            "tests": args.tests,
+            "input_sizes": args.input_sizes,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "submissions": args.submissions,
+        },
+        "spawn": [],
+        "run": [],
+        "submit": [],
+    }
+    async with httpx.AsyncClient(base_url=url, timeout=None) as client:
+        await wait_for_server(client)
+        # Compiles and warms up every language once, outside the measurements
+        for language in args.languages:
+            await client.post("/run/", json={"source_code": SOLUTIONS[language], "language": language, "input_data": "1\n1\n"})
+
+        for language in args.languages:
+            log(f"spawn {language}")
+            results["spawn"].append(await bench_spawn(client, language, args.requests))
+
+        for language in args.languages:
+            for size in args.input_sizes:
+                input_data, expected = make_input(size, rng)
+                for concurrency in args.concurrency:
+                    log(f"run {language} {size} bytes x{concurrency}")
+                    results["run"].append(
+                        await bench_run(client, language, input_data, expected, concurrency, args.requests)
+                    )
+
+        run_id = rng.randrange(10**6)
+        for tests in args.tests:
+            for size in args.input_sizes:
+                code = await add_problem(client, f"Bench {run_id} {tests} tests {size} bytes", tests, size, rng)
+                for language in args.languages:
+                    for concurrency in args.concurrency:
+                        log(f"submit {language} {tests} tests {size} bytes x{concurrency}")
+                        results["submit"].append(
+                            await bench_submit(client, code, language, tests, size, concurrency, args.submissions)
+                        )
+
+        results["memory"] = {
+            "api_peak_rss_mb": peak_rss_mb(pid) if pid else None,
+            "judge_workers_peak_rss_mb": [
+                peak_rss_mb(child) for child in child_pids(pid)
+            ] if pid else [],
+        }
+    return results
+
+
+def scenario_key(kind: str, scenario: dict) -> tuple:
+    return (kind,) + tuple(
+        scenario.get(field) for field in ("language", "tests", "input_bytes", "concurrency")
+    )
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Scenarios slower than the baseline by more than tolerance (0.2 = 20%)."""
+    regressions = []
+    checks = {
+        "run": [("requests_per_sec", -1), ("latency_ms", 1)],
+        "submit": [("submissions_per_sec", -1), ("submission_latency_ms", 1)],
+        "spawn": [("sandbox_ms", 1)],
+    }
+    for kind, metrics in checks.items():
+        before = {scenario_key(kind, s): s for s in baseline.get(kind, [])}
+        for scenario in results.get(kind, []):
+            old = before.get(scenario_key(kind, scenario))
+            if not old:
+                continue
+            for metric, direction in metrics:
+                new_value, old_value = scenario[metric], old[metric]
+                if isinstance(new_value, dict):
+                    new_value, old_value = new_value["p95"], old_value["p95"]
+                    metric += ".p95"
+                if not new_value or not old_value:
+                    continue
+                change = (new_value - old_value) / old_value * direction
+                if change > tolerance:
+                    name = " ".join(str(part) for part in scenario_key(kind, scenario) if part is not None)
+                    regressions.append(f"{name}: {metric} {old_value} -> {round(new_value, 3)}")
+    return regressions
+
+
+def log(message: str):
+    print(message, file=sys.stderr, flush=True)
+
+
+def int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the judge")
+    parser.add_argument("--url", help="API to benchmark, instead of starting one")
+    parser.add_argument(
+        "--database-url", help="empty database for the started API, instead of a new SQLite one"
+    )
+    parser.add_argument("--languages", type=lambda v: v.split(","), default=list(SOLUTIONS))
+    parser.add_argument("--tests", type=int_list, default=[1, 10], help="tests per problem")
+    parser.add_argument("--input-sizes", type=int_list, default=[100, 100_000], help="bytes per test input")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 8])
+    parser.add_argument("--requests", type=int, default=20, help="runs per run scenario")
+    parser.add_argument("--submissions", type=int, default=16, help="submissions per submit scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results here instead of stdout")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    for language in args.languages:
+        if language not in SOLUTIONS:
+            parser.error(f"Unknown language: {language}")
+
+    if args.url:
+        results = asyncio.run(benchmark(args, args.url))
+    else:
+        with tempfile.TemporaryDirectory(prefix="codeforge-bench-") as directory:
+            port = free_port()
+            server = start_server(directory, port, args.database_url)
+            try:
+                results = asyncio.run(
+                    benchmark(args, f"http://127.0.0.1:{port}", server.pid)
+                )
+            finally:
+                server.terminate()
+                server.wait()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            log(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
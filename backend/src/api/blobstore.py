@@ -0,0 +1,70 @@
+import contextlib
+import hashlib
+import mmap
+import os
+
+from api import config
+
+
+class Blob:
+    """A stored file, opened only when a run needs it."""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+
+    def open(self):
+        return open(self.path, "rb")
+
+    @contextlib.contextmanager
+    def mapped(self):
+        """Read-only memory map of the file, empty files can't be mapped."""
+        if self.size == 0:
+            yield b""
+            return
+        with self.open() as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield data
+        finally:
+            data.close()
+
+
+class BlobStore:
+    """Content-addressed files: each distinct content is stored once, under
+    its sha256, so the database only keeps hashes and sizes."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def put(self, data: bytes) -> tuple[str, int]:
+        """Store data, returns its (hash, size)."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest, len(data)
+
+    def put_text(self, text: str, normalize_newlines: bool = False) -> tuple[str, int]:
+        # Expected outputs are compared with LF newlines, so they are stored that way
+        if normalize_newlines:
+            text = text.replace("\r\n", "\n")
+        return self.put(text.encode())
+
+    def get(self, digest: str, size: int) -> Blob:
+        return Blob(self.path(digest), size)
+
+    def read_text(self, digest: str) -> str:
+        with open(self.path(digest), "rb") as f:
+            return f.read().decode()
+
+
+blobs = BlobStore(config.TESTDATA_DIR)
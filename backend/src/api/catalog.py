@@ -0,0 +1,93 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from api import config
+from api.models import Contests, Problems, Submissions
+
+
+class Catalog:
+    """Problem list and contests kept in memory, plus each user's solved
+    problems as a bitmap of problem ids, so the list pages need no queries.
+
+    The catalog is reloaded after invalidate() (called when problems or
+    contests are added) or after `ttl` seconds, which covers changes made by
+    other processes. Solved sets are loaded per user and updated by
+    mark_solved as submissions are judged, they are also reloaded after `ttl`
+    seconds in case a backplane message was lost.
+    """
+
+    def __init__(self, ttl: float, max_users: int):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.problems: dict[int | None, list] = {}  # contest id -> problems
+        self.contests: dict[str, Contests] = {}  # code -> contest
+        self.loaded_at = None
+        self.version = 0  # bumped by invalidate()
+        self.lock = asyncio.Lock()
+        # username -> (bitmap of solved problem ids, load time), least recently used first
+        self.solved: OrderedDict[str, tuple[int, float]] = OrderedDict()
+        # Problems solved by users whose bitmap is being loaded
+        self.loading: dict[str, int] = {}
+
+    def invalidate(self):
+        self.version += 1
+        self.loaded_at = None
+
+    async def load(self):
+        async with self.lock:
+            if self.loaded_at and time.monotonic() - self.loaded_at < self.ttl:
+                return
+            loaded_at, version = time.monotonic(), self.version
+            problems = {}
+            for problem in await Problems.get_catalog():
+                problems.setdefault(problem.contest_id, []).append(problem)
+            contests = {contest.code: contest for contest in await Contests.get_all()}
+            self.problems, self.contests = problems, contests
+            # Invalidated while loading, the next call loads again
+            if version == self.version:
+                self.loaded_at = loaded_at
+
+    async def get_contest(self, code: str) -> Contests | None:
+        await self.load()
+        if code in self.contests:
+            return self.contests[code]
+        # Possibly added by another process since the last load
+        return await Contests.get(code)
+
+    async def get_problems(self, contest_id: int | None, username: str):
+        """[(problem, is_solved)] of a contest, or of the arena for None."""
+        await self.load()
+        solved = await self.solved_bits(username)
+        return [
+            (problem, bool(solved >> problem.id & 1))
+            for problem in self.problems.get(contest_id, [])
+        ]
+
+    async def solved_bits(self, username: str) -> int:
+        entry = self.solved.get(username)
+        if entry and time.monotonic() - entry[1] < self.ttl:
+            self.solved.move_to_end(username)
+            return entry[0]
+        self.loading.setdefault(username, 0)
+        loaded_at = time.monotonic()
+        bits = 0
+        for problem_id in await Submissions.get_solved(username):
+            bits |= 1 << problem_id
+        # Keep anything marked solved while the query ran
+        bits |= self.loading.pop(username, 0)
+        self.solved[username] = (bits, loaded_at)
+        self.solved.move_to_end(username)
+        while len(self.solved) > self.max_users:
+            self.solved.popitem(last=False)
+        return bits
+
+    def mark_solved(self, username: str, problem_id: int):
+        if username in self.solved:
+            bits, loaded_at = self.solved[username]
+            self.solved[username] = (bits | 1 << problem_id, loaded_at)
+        if username in self.loading:
+            self.loading[username] |= 1 << problem_id
+
+
+catalog = Catalog(config.CATALOG_TTL, config.CATALOG_MAX_USERS)
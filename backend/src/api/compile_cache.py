@@ -0,0 +1,120 @@
+import hashlib
+import os
+import shutil
+import time
+
+from api.metrics import compile_cache_total, totals
+
+# Eviction goes down to this fraction of max_bytes, so it isn't needed again
+# for the next put
+EVICT_TO = 0.9
+# Seconds between scans of the directory, to count what other processes added
+SCAN_INTERVAL = 60
+
+
+class CompileCache:
+    """On-disk cache of compiled binaries with LRU eviction.
+
+    Entries are keyed by a hash of the language, compiler flags and source, so
+    identical submissions skip the compiler entirely.
+
+    The directory is the only state, so every process sharing it (the API and
+    the judge workers) sees the same entries and the size cap applies to all of
+    them. A hit touches the file's mtime, eviction removes the oldest first.
+
+    Listing the directory costs as much as it has entries, so a put only adds
+    to an estimate of the total size. The directory is scanned when that goes
+    over max_bytes, or every SCAN_INTERVAL for the other processes' puts.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.estimated_bytes = 0
+        self.scanned_at = 0
+        os.makedirs(directory, exist_ok=True)
+        self._evict()
+
+    @staticmethod
+    def key(source_code: str, language: str, flags: list[str]) -> str:
+        digest = hashlib.sha256()
+        for part in (language, *flags, source_code):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key: str, dest: str) -> bool:
+        """Copy the cached binary for key to dest, returns False on a miss."""
+        path = os.path.join(self.directory, key)
+        try:
+            # Copy rather than link, the sandbox must not be able to touch the cache
+            shutil.copy2(path, dest)
+            os.utime(path)
+        except FileNotFoundError:
+            # Not compiled yet, or evicted by any process sharing the directory
+            compile_cache_total.inc("miss")
+            return False
+        compile_cache_total.inc("hit")
+        return True
+
+    def put(self, key: str, src: str):
+        path = os.path.join(self.directory, key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        shutil.copy2(src, tmp_path)
+        os.chmod(tmp_path, 0o755)
+        os.replace(tmp_path, path)
+        # copy2 kept the compiler's mtime, this is the most recent entry
+        os.utime(path)
+        self.estimated_bytes += os.path.getsize(path)
+        if (
+            self.estimated_bytes > self.max_bytes
+            or time.monotonic() - self.scanned_at > SCAN_INTERVAL
+        ):
+            self._evict()
+
+    def _entries(self) -> list[tuple[str, int, float]]:
+        """(name, size, mtime) of every cached binary, least recently used first."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            # Skips the .tmp files of copies in progress
+            if "." in entry.name:
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry.name, stat.st_size, stat.st_mtime))
+        entries.sort(key=lambda entry: entry[2])
+        return entries
+
+    def _evict(self):
+        entries = self._entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        self.scanned_at = time.monotonic()
+        self.estimated_bytes = total_bytes
+        if total_bytes <= self.max_bytes:
+            return
+        for name, size, _ in entries:
+            if total_bytes <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                compile_cache_total.inc("eviction")
+            except FileNotFoundError:
+                # Another process evicted it first
+                pass
+            total_bytes -= size
+        self.estimated_bytes = total_bytes
+
+    def stats(self) -> dict:
+        """Entries on disk, and lookups of every process (see api.metrics)."""
+        entries = self._entries()
+        counts = totals()[compile_cache_total.name]
+        return {
+            "hits": counts.get(("hit",), 0),
+            "misses": counts.get(("miss",), 0),
+            "evictions": counts.get(("eviction",), 0),
+            "entries": len(entries),
+            "size_bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+from api import config
+
+
+class CachedResponse:
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.created_at = time.monotonic()
+
+
+class ResponseCache:
+    """Serialized JSON responses for reads that rarely change, with an ETag
+    so clients can revalidate with a conditional GET.
+
+    There's no Last-Modified: the data can change in another process without
+    this one knowing until the entry expires, the ETag is always correct.
+
+    invalidate() drops everything when this process changes the data, entries
+    also expire after `ttl` seconds for changes made by other processes.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple, CachedResponse] = OrderedDict()
+        self.version = 0  # bumped by invalidate()
+
+    def invalidate(self):
+        self.version += 1
+        self.entries.clear()
+
+    async def respond(self, request: Request, key: tuple, build) -> Response | None:
+        """Response for key, from the cache or from `await build()`.
+
+        Returns None, and caches nothing, when build returns None (not found).
+        """
+        entry = self.entries.get(key)
+        if entry and time.monotonic() - entry.created_at > self.ttl:
+            entry = None
+        if entry:
+            self.entries.move_to_end(key)
+        else:
+            version = self.version
+            content = await build()
+            if content is None:
+                return None
+            # Same encoding as FastAPI's JSONResponse
+            body = json.dumps(
+                jsonable_encoder(content), ensure_ascii=False, separators=(",", ":")
+            )
+            entry = CachedResponse(body.encode())
+            # Invalidated while building, don't keep what may be stale
+            if version == self.version:
+                self.entries[key] = entry
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+        headers = {
+            "ETag": entry.etag,
+            # Cache, but always check with us first
+            "Cache-Control": "no-cache",
+        }
+        if not_modified(request, entry):
+            return Response(status_code=304, headers=headers)
+        return Response(entry.body, media_type="application/json", headers=headers)
+
+
+def not_modified(request: Request, entry: CachedResponse) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or entry.etag in tags
+    return False
+
+
+responses = ResponseCache(config.HTTP_CACHE_TTL, config.HTTP_CACHE_MAX_ENTRIES)
@@ -0,0 +1,151 @@
+"""Import problems from a JSON file (a list like problems.json) without loading
+the whole file into memory:
+
+    python -m api.importer problems.json --owner admin [--contest CODE]
+"""
+
+import argparse
+import asyncio
+import json
+
+from api.models import Contests, Problems, close_db, init_db
+
+CHUNK_SIZE = 64 * 1024
+BATCH_SIZE = 20
+# A number is only known to be complete once this many characters follow it:
+# decoding "1e+" stops at 1 and leaves "e+", which the next chunk may continue
+NUMBER_LOOKAHEAD = 3
+
+decoder = json.JSONDecoder()
+
+
+def iter_json_array(file, chunk_size: int = CHUNK_SIZE):
+    """Yield the items of a top-level JSON array one at a time."""
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill(size):
+        nonlocal buffer, pos, eof
+        data = file.read(size)
+        if not data:
+            eof = True
+        buffer = buffer[pos:] + data
+        pos = 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill(chunk_size)
+
+    fill(chunk_size)
+    skip_whitespace()
+    if buffer[pos:pos + 1] != "[":
+        raise ValueError("Expected a JSON array")
+    pos += 1
+
+    first = True
+    while True:
+        skip_whitespace()
+        if pos >= len(buffer):
+            raise ValueError("Unexpected end of JSON array")
+        if buffer[pos] == "]":
+            return
+        if not first:
+            if buffer[pos] != ",":
+                raise ValueError(f"Expected ',' in JSON array, got {buffer[pos]!r}")
+            pos += 1
+            skip_whitespace()
+        first = False
+
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                item, end = None, len(buffer)
+            # A number near the end of the buffer might continue in the next chunk
+            if eof or (
+                end < len(buffer)
+                and not (type(item) in (int, float) and len(buffer) - end < NUMBER_LOOKAHEAD)
+            ):
+                break
+            # Read at least as much as is buffered, so a huge item is parsed
+            # a logarithmic number of times
+            fill(max(chunk_size, len(buffer) - pos))
+        pos = end
+        yield item
+
+
+def problem_from_json(problem: dict, owner: str, contest_id: int | None):
+    return (
+        Problems(
+            title=problem["title"],
+            difficulty=problem["difficulty"],
+            problem_statement=problem["problem_statement"],
+            constraints=problem["constraints"],
+            owner=owner,
+            contest_id=contest_id,
+        ),
+        problem["testcases"],
+    )
+
+
+async def import_problems(
+    path: str, owner: str, contest_id=None, batch_size: int = BATCH_SIZE, session=None
+) -> int:
+    """Add every problem of the file, batch_size problems per transaction, or
+    all of them in the given session's transaction. contest_id may be a
+    function of the problem's index in the file."""
+    count = 0
+    batch = []
+    with open(path) as f:
+        for problem in iter_json_array(f):
+            problem_contest = contest_id(count) if callable(contest_id) else contest_id
+            batch.append(problem_from_json(problem, owner, problem_contest))
+            count += 1
+            if len(batch) >= batch_size:
+                await add_batch(batch, session)
+                batch = []
+    if batch:
+        await add_batch(batch, session)
+    return count
+
+
+async def add_batch(batch, session=None):
+    if session is not None:
+        added = await Problems.insert_all(session, batch)
+    else:
+        added = await Problems.add_all(batch)
+    if not added:
+        titles = ", ".join(problem.title for problem, _ in batch)
+        raise ValueError(f"Invalid title in: {titles}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Import problems from a JSON file")
+    parser.add_argument("path")
+    parser.add_argument("--owner", default="admin")
+    parser.add_argument("--contest", help="contest code to add the problems to")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    await init_db()
+    contest_id = None
+    if args.contest:
+        contest = await Contests.get(args.contest)
+        if not contest:
+            parser.error(f"Contest not found: {args.contest}")
+        contest_id = contest.id
+    count = await import_problems(args.path, args.owner, contest_id, args.batch_size)
+    print("Imported problems:", count)
+    await close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+import asyncio
+from typing import AsyncIterator, Callable
+
+from pydantic import BaseModel
+
+from api.metrics import stage_seconds, submission_seconds, submissions_total
+from api.models import Problems, SubmissionLog, TestCases
+from api.routes.run import Program, RunRequest, RunResponse
+
+
+class SubmitResult(BaseModel):
+    is_solved: bool
+    total_passed: int
+    elapsed_time: float
+    memory_used: float
+    results: list[RunResponse]
+
+
+async def judge_tests(
+    program: Program, testcases: list, fail_fast: bool = False
+) -> AsyncIterator[tuple[int, RunResponse]]:
+    """Run all tests concurrently, yielding (index, result) as each one finishes.
+
+    With fail_fast the remaining tests are cancelled after the first failure.
+    """
+
+    async def run_test(index, testcase):
+        return index, await program.run(
+            testcase.input_blob(), testcase.output_blob()
+        )
+
+    tasks = [
+        asyncio.create_task(run_test(index, testcase))
+        for index, testcase in enumerate(testcases)
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, result = await next_done
+            yield index, result
+            if fail_fast and not result.test_passed:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def verdict(results: list[RunResponse], is_solved: bool) -> str:
+    if is_solved:
+        return "Accepted"
+    # The first test that didn't run cleanly, in test order
+    for result in results:
+        if result.message not in ("Success", "Skipped"):
+            return result.message
+    return "Wrong answer"
+
+
+async def judge_submission(
+    problem: Problems,
+    run_req: RunRequest,
+    fail_fast: bool = False,
+    on_result: Callable[[int, RunResponse], None] | None = None,
+) -> SubmitResult:
+    """Judge and record a submission, calling on_result for every finished test."""
+    with submission_seconds.time(run_req.language.value):
+        return await judge_and_record(problem, run_req, fail_fast, on_result)
+
+
+async def judge_and_record(
+    problem: Problems,
+    run_req: RunRequest,
+    fail_fast: bool,
+    on_result: Callable[[int, RunResponse], None] | None,
+) -> SubmitResult:
+    testcases = await TestCases.get(problem.id)
+    all_results = [RunResponse(message="Skipped") for _ in testcases]
+    total_passed, total_elapsed_time, total_memory_used = 0, 0, 0
+    with Program(run_req.source_code, run_req.language) as program:
+        # Compile once for the whole submission, a failure is a single verdict
+        error = await program.compile()
+        if error:
+            all_results = [error]
+            if on_result:
+                on_result(0, error)
+        else:
+            async for index, result in judge_tests(program, testcases, fail_fast):
+                if result.message == "Success":
+                    if result.test_passed:
+                        total_passed += 1
+                    total_elapsed_time += result.elapsed_time
+                    total_memory_used += result.memory_usage or 0
+                all_results[index] = result
+                if on_result:
+                    on_result(index, result)
+
+    is_solved = error is None and total_passed == len(testcases)
+    submission_verdict = verdict(all_results, is_solved)
+    submissions_total.inc(run_req.language.value, submission_verdict)
+
+    with stage_seconds.time("db_write"):
+        await SubmissionLog(
+            problem_id=problem.id,
+            contest_id=problem.contest_id,
+            username=run_req.username,
+            language=run_req.language.value,
+            source_code=run_req.source_code,
+            verdict=submission_verdict,
+            is_solved=is_solved,
+            total_passed=total_passed,
+            total_tests=len(testcases),
+            elapsed_time=total_elapsed_time,
+            memory_used=total_memory_used,
+        ).add()
+
+    return SubmitResult(
+        is_solved=is_solved,
+        total_passed=total_passed,
+        elapsed_time=total_elapsed_time,
+        memory_used=total_memory_used,
+        results=all_results,
+    )
@@ -0,0 +1,246 @@
+"""Counters and histograms of the judge, served at GET /metrics in the
+Prometheus text format.
+
+Each process (API and judge workers) counts in memory and writes a snapshot
+to CODEFORGE_METRICS_DIR every CODEFORGE_METRICS_INTERVAL seconds, /metrics
+adds up the snapshots of the processes still running.
+
+Verbose tracing of every run (command, source, output) goes through trace(),
+it is off unless CODEFORGE_TRACE is set or it is switched on at runtime with
+PUT /metrics/trace, which applies to every process sharing the directory.
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import time
+
+from api import config
+
+# Seconds, from a cached compile to a slow test
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = {}
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+        registry[name] = self
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def snapshot(self) -> list:
+        return [[list(key), value] for key, value in self.values.items()]
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., count above the last, sum]
+        self.values: dict[tuple, list] = {}
+        registry[name] = self
+
+    def observe(self, value: float, *label_values):
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-2] += 1
+        counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def snapshot(self) -> list:
+        return [[list(key), counts] for key, counts in self.values.items()]
+
+
+stage_seconds = Histogram(
+    "codeforge_stage_seconds",
+    "Time spent in each stage of running and judging code",
+    ("stage",),
+)
+submission_seconds = Histogram(
+    "codeforge_submission_seconds",
+    "Time to judge and record a submission",
+    ("language",),
+)
+runs_total = Counter(
+    "codeforge_runs_total", "Programs run against an input", ("language", "result")
+)
+submissions_total = Counter(
+    "codeforge_submissions_total", "Submissions judged", ("language", "verdict")
+)
+compile_cache_total = Counter(
+    "codeforge_compile_cache_total",
+    "Compile cache lookups and evictions",
+    ("result",),
+)
+websockets_dropped_total = Counter(
+    "codeforge_websockets_dropped_total",
+    "Websockets dropped because a send failed or timed out",
+)
+
+
+def snapshot() -> dict:
+    return {name: metric.snapshot() for name, metric in registry.items()}
+
+
+def snapshot_path(pid: int) -> str:
+    return os.path.join(config.METRICS_DIR, f"{pid}.json")
+
+
+def write_snapshot():
+    os.makedirs(config.METRICS_DIR, exist_ok=True)
+    path = snapshot_path(os.getpid())
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(f"{path}.tmp", path)
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect() -> list[dict]:
+    """This process' metrics and the last snapshot of every other one."""
+    snapshots = [snapshot()]
+    if not os.path.isdir(config.METRICS_DIR):
+        return snapshots
+    for name in os.listdir(config.METRICS_DIR):
+        pid, _, extension = name.partition(".")
+        if extension != "json" or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        path = os.path.join(config.METRICS_DIR, name)
+        if not is_running(int(pid)):
+            # Its counts go with it, like any restarted Prometheus target
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            continue
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def totals() -> dict[str, dict[tuple, list | float]]:
+    """Every metric added up over all processes, by label values."""
+    result: dict[str, dict[tuple, list | float]] = {name: {} for name in registry}
+    for process_snapshot in collect():
+        for name, values in process_snapshot.items():
+            if name not in result:
+                continue
+            for key, value in values:
+                key = tuple(key)
+                if isinstance(value, list):
+                    total = result[name].setdefault(key, [0] * len(value))
+                    for i, count in enumerate(value):
+                        total[i] += count
+                else:
+                    result[name][key] = result[name].get(key, 0) + value
+    return result
+
+
+def render() -> str:
+    """All processes' metrics in the Prometheus text format."""
+    all_totals = totals()
+    lines = []
+    for name, metric in registry.items():
+        kind = "histogram" if isinstance(metric, Histogram) else "counter"
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key, value in sorted(all_totals[name].items()):
+            labels = list(zip(metric.labels, key))
+            if kind == "counter":
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets, value):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + [('le', bound)])} {cumulative}")
+            cumulative += value[-2]
+            lines.append(f"{name}_bucket{format_labels(labels + [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: list) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+trace_logger = logging.getLogger("api.trace")
+trace_logger.setLevel(logging.INFO)
+trace_logger.propagate = False
+_handler = logging.StreamHandler()
+_handler.setFormatter(logging.Formatter("%(asctime)s [%(process)d] %(message)s"))
+trace_logger.addHandler(_handler)
+
+tracing = config.TRACE
+
+
+def trace(message: str, *args):
+    """Log a line about a run, only formatted when tracing is on."""
+    if tracing:
+        trace_logger.info(message, *args)
+
+
+def trace_flag() -> str:
+    return os.path.join(config.METRICS_DIR, "trace")
+
+
+def set_tracing(enabled: bool):
+    """Switch tracing for every process, they notice within METRICS_INTERVAL."""
+    global tracing
+    tracing = enabled
+    os.makedirs(config.METRICS_DIR, exist_ok=True)
+    if enabled:
+        open(trace_flag(), "a").close()
+    else:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(trace_flag())
+
+
+async def write_snapshots():
+    """Keep this process' snapshot up to date and follow the tracing switch."""
+    global tracing
+    while True:
+        await asyncio.sleep(config.METRICS_INTERVAL)
+        try:
+            tracing = os.path.exists(trace_flag())
+            write_snapshot()
+        except OSError as e:
+            print("Writing metrics failed:", e)
@@ -1,20 +1,31 @@
+import asyncio
+import contextlib
 import datetime
-import json
+import fcntl
 import os
+import shutil
+import time
 
-from sqlmodel import Field, Session, SQLModel, case, create_engine, func, select
+from sqlalchemy import Index, Integer, UniqueConstraint, cast, event, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Field, SQLModel, case, func, insert, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from api import config
+from api.blobstore import Blob, blobs
 
 
 class Users(SQLModel, table=True):
     username: str = Field(primary_key=True)
 
-    def create(self):
-        with Session(engine) as session:
-            if session.get(Users, self.username):
+    async def create(self):
+        async with new_session() as session:
+            if await session.get(Users, self.username):
                 return
             session.add(self)
-            session.commit()
-            session.refresh(self)
+            await session.commit()
+            await session.refresh(self)
 
 
 class Contests(SQLModel, table=True):
@@ -25,75 +36,38 @@ class Contests(SQLModel, table=True):
     date: datetime.date | None = Field(default=None, nullable=False)
     owner: str = Field(foreign_key="users.username")
 
-    def add(self):
-        with Session(engine) as session:
-            self.code = generate_code(self.title, Contests)
+    async def add(self):
+        async with new_session() as session:
+            self.code = await generate_code(session, self.title, Contests)
             if not self.code:
                 return
             self.date = datetime.date.today()
             session.add(self)
-            session.commit()
-            session.refresh(self)
+            await session.commit()
+            await session.refresh(self)
             return self
 
-    def get_all():
-        with Session(engine) as session:
-            contests = session.exec(select(Contests)).all()
+    async def get_all():
+        async with new_session() as session:
+            contests = (await session.exec(select(Contests))).all()
             return contests
 
-    def get(code: str):
-        with Session(engine) as session:
-            contest = session.exec(
+    async def get(code: str):
+        async with new_session() as session:
+            contest = (await session.exec(
                 select(Contests).where(Contests.code == code)
-            ).first()
+            )).first()
             return contest
         
     #get code from contest id
-    def get_code(id: int):
-        with Session(engine) as session:
-            contest = session.exec(
+    async def get_code(id: int):
+        async with new_session() as session:
+            contest = (await session.exec(
                 select(Contests).where(Contests.id == id)
-            ).first()
+            )).first()
             if contest:
                 return contest.code
 
-    def get_problems(self, username: str):
-        with Session(engine) as session:
-            subquery = (
-                select(Submissions).where(Submissions.username == username).subquery()
-            )
-
-            problems = session.exec(
-                select(Problems, subquery.c.is_solved)
-                .join(
-                    subquery,
-                    Problems.id == subquery.c.problem_id,
-                    isouter=True,
-                )
-                .where(
-                    Problems.contest_id == self.id,
-                )
-            ).all()
-            return problems
-        
-    def get_leaderboard(id: int):
-        with Session(engine) as session:
-            statement = (
-                select(
-                    Submissions.username,
-                    func.count(Submissions.is_solved).label("solved_problems"),
-                    func.sum(Submissions.elapsed_time).label("total_time")
-                )
-                .where(Submissions.contest_id == id, Submissions.is_solved == True)
-                .group_by(Submissions.username)
-                .order_by(
-                    func.count(Submissions.is_solved).desc(),
-                    func.sum(Submissions.elapsed_time)
-                )
-            )
-            leaderboard = session.exec(statement).all()
-            return leaderboard
-
 
 class Problems(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
@@ -108,74 +82,192 @@ class Problems(SQLModel, table=True):
     def __repr__(self):
         return f"{self.code}: {self.title} - {self.difficulty} by {self.owner}"
 
-    def add(self):
-        with Session(engine) as session:
-            self.code = generate_code(self.title, Problems)
-            if not self.code:
-                return
-            session.add(self)
-            session.commit()
-            session.refresh(self)
-            return self
-
-    def get_all(username: str):
-        with Session(engine) as session:
-            subquery = (
-                select(Submissions).where(Submissions.username == username).subquery()
-            )
-
-            problems = session.exec(
-                select(Problems, subquery.c.is_solved)
-                .join(
-                    subquery,
-                    Problems.id == subquery.c.problem_id,
-                    isouter=True,
-                )
-                .where(
-                    Problems.contest_id.is_(None),
-                )
-            ).all()
-            return problems
-
-    def get(code: str):
-        with Session(engine) as session:
-            problem = session.exec(
+    async def get_catalog():
+        """Every problem without its statement, for the problem lists."""
+        async with new_session() as session:
+            return (await session.exec(
+                select(
+                    Problems.id,
+                    Problems.code,
+                    Problems.title,
+                    Problems.difficulty,
+                    Problems.contest_id,
+                ).order_by(Problems.id)
+            )).all()
+
+    async def get(code: str):
+        async with new_session() as session:
+            problem = (await session.exec(
                 select(Problems).where(Problems.code == code)
-            ).first()
+            )).first()
             return problem
 
-    def add_testcases(self, testcases: list[dict[str, str]]):
-        for testcase in testcases:
-            TestCases(
-                input=testcase["input"],
-                output=testcase["output"],
-                problem_id=self.id,
-            ).add()
+    async def get_by_id(id: int):
+        async with new_session() as session:
+            return await session.get(Problems, id)
+
+    async def add_all(problems: list[tuple["Problems", list[dict[str, str]]]]):
+        """Insert problems and all of their testcases in one transaction.
+        Nothing is added if a title is invalid (returns None) or a testcase is
+        missing its input or output (raises KeyError)."""
+        async with new_session() as session:
+            added = await Problems.insert_all(session, problems)
+            if added:
+                await session.commit()
+            return added
+
+    async def insert_all(
+        session: AsyncSession, problems: list[tuple["Problems", list[dict[str, str]]]]
+    ):
+        """add_all in the caller's transaction, which must be rolled back on None."""
+        rows = [
+            [TestCases.from_dict(t) for t in testcases] for _, testcases in problems
+        ]
+        for problem, _ in problems:
+            problem.code = await generate_code(session, problem.title, Problems)
+            if not problem.code:
+                return None
+        session.add_all([problem for problem, _ in problems])
+        await session.flush()
+        testcases = [
+            {**testcase, "problem_id": problem.id}
+            for (problem, _), tests in zip(problems, rows)
+            for testcase in tests
+        ]
+        if testcases:
+            await session.execute(insert(TestCases), testcases)
+        return [problem for problem, _ in problems]
 
 
 class TestCases(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    input: str
-    output: str
+    # Contents live in the blob store (api.blobstore), outputs with LF newlines
+    input_hash: str
+    input_size: int
+    output_hash: str
+    output_size: int
+    problem_id: int = Field(foreign_key="problems.id", index=True)
+
+    def from_dict(testcase: dict[str, str], problem_id: int | None = None) -> dict:
+        """Store a {"input", "output"} testcase's data, returns the row's values."""
+        input_hash, input_size = blobs.put_text(testcase["input"])
+        output_hash, output_size = blobs.put_text(
+            testcase["output"], normalize_newlines=True
+        )
+        return {
+            "input_hash": input_hash,
+            "input_size": input_size,
+            "output_hash": output_hash,
+            "output_size": output_size,
+            "problem_id": problem_id,
+        }
+
+    def input_blob(self) -> Blob:
+        return blobs.get(self.input_hash, self.input_size)
+
+    def output_blob(self) -> Blob:
+        return blobs.get(self.output_hash, self.output_size)
+
+    def to_dict(self) -> dict[str, str]:
+        return {
+            "input": blobs.read_text(self.input_hash),
+            "output": blobs.read_text(self.output_hash),
+        }
+
+    async def get(problem_id: int):
+        async with new_session() as session:
+            testcases = (await session.exec(
+                select(TestCases)
+                .where(TestCases.problem_id == problem_id)
+                .order_by(TestCases.id)
+            )).all()
+            return testcases
+
+    async def get_samples(problem_id: int, offset: int = 0, limit: int | None = None):
+        """The problem's first config.SAMPLE_TESTS testcases, or a page of them."""
+        limit = config.SAMPLE_TESTS - offset if limit is None else limit
+        limit = min(limit, config.SAMPLE_TESTS - offset)
+        if limit <= 0:
+            return []
+        async with new_session() as session:
+            return (await session.exec(
+                select(TestCases)
+                .where(TestCases.problem_id == problem_id)
+                .order_by(TestCases.id)
+                .offset(offset)
+                .limit(limit)
+            )).all()
+
+
+class SubmissionLog(SQLModel, table=True):
+    """Every judged attempt, never updated. Submissions holds the best one per
+    problem and user, derived from this log as attempts are added."""
+
+    __table_args__ = (
+        Index("ix_submissionlog_problem_user", "problem_id", "username"),
+        Index("ix_submissionlog_contest_created", "contest_id", "created_at"),
+    )
+
+    id: int | None = Field(default=None, primary_key=True)
     problem_id: int = Field(foreign_key="problems.id")
+    contest_id: int | None = Field(default=None, foreign_key="contests.id")
+    username: str = Field(foreign_key="users.username")
+    language: str
+    source_code: str
+    verdict: str
+    is_solved: bool = False
+    total_passed: int
+    total_tests: int
+    elapsed_time: float
+    memory_used: float
+    created_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
 
-    def add(self):
-        with Session(engine) as session:
+    async def add(self) -> "Submissions":
+        """Append the attempt and update the best submission and contest
+        standings in the same transaction, returns the best submission."""
+        async with new_session() as session:
+            # Writing first takes SQLite's write lock before anything is read
             session.add(self)
-            session.commit()
-            session.refresh(self)
-
-    def get(problem_id: int):
-        with Session(engine) as session:
-            testcases = session.exec(
-                select(TestCases.input, TestCases.output).where(
-                    TestCases.problem_id == problem_id
+            await session.flush()
+            best = await Submissions.record(session, self)
+            await session.commit()
+            await session.refresh(best)
+            return best
+
+    async def get_history(problem_id: int, username: str, offset=0, limit=50):
+        """A user's attempts at a problem, newest first, without the source."""
+        async with new_session() as session:
+            return (await session.exec(
+                select(
+                    SubmissionLog.id,
+                    SubmissionLog.language,
+                    SubmissionLog.verdict,
+                    SubmissionLog.is_solved,
+                    SubmissionLog.total_passed,
+                    SubmissionLog.total_tests,
+                    SubmissionLog.elapsed_time,
+                    SubmissionLog.memory_used,
+                    SubmissionLog.created_at,
                 )
-            ).all()
-            return testcases
+                .where(
+                    SubmissionLog.problem_id == problem_id,
+                    SubmissionLog.username == username,
+                )
+                .order_by(SubmissionLog.id.desc())
+                .offset(offset)
+                .limit(limit)
+            )).all()
 
 
 class Submissions(SQLModel, table=True):
+    """Best attempt per problem and user, see SubmissionLog."""
+
+    __table_args__ = (
+        Index("ix_submissions_problem_user", "problem_id", "username", unique=True),
+        Index("ix_submissions_contest_updated", "contest_id", "updated_at"),
+        Index("ix_submissions_username", "username"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     problem_id: int = Field(foreign_key="problems.id")
     contest_id: int | None = Field(foreign_key="contests.id")
@@ -184,85 +276,615 @@ class Submissions(SQLModel, table=True):
     total_passed: int
     elapsed_time: float
     memory_used: float
-    updated_at: datetime.datetime = Field(default=datetime.datetime.now)
-
-    def add(self):
-        with Session(engine) as session:
-            self.updated_at = datetime.datetime.now()
-            session.add(self)
-            session.commit()
-            session.refresh(self)
-
-    def get(problem_id: int, username: str):
-        with Session(engine) as session:
-            submission = session.exec(
-                select(Submissions).where(
+    updated_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
+
+    def beats(self, other) -> bool:
+        if self.is_solved != other.is_solved:
+            return self.is_solved
+        if self.is_solved:
+            return self.elapsed_time < other.elapsed_time
+        return self.total_passed > other.total_passed
+
+    async def record(session: AsyncSession, attempt: SubmissionLog) -> "Submissions":
+        """Make attempt the best submission if it beats the current one, and
+        apply the change to the contest standings."""
+        values = {
+            "problem_id": attempt.problem_id,
+            "contest_id": attempt.contest_id,
+            "username": attempt.username,
+            "is_solved": attempt.is_solved,
+            "total_passed": attempt.total_passed,
+            "elapsed_time": attempt.elapsed_time,
+            "memory_used": attempt.memory_used,
+            "updated_at": datetime.datetime.now(),
+        }
+        # A first attempt inserts the row, concurrent first attempts can't both do it
+        inserted = (await session.execute(
+            upsert(Submissions)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=["problem_id", "username"])
+        )).rowcount
+        best = (await session.exec(
+            select(Submissions)
+            .where(
+                Submissions.problem_id == attempt.problem_id,
+                Submissions.username == attempt.username,
+            )
+            .with_for_update()
+        )).one()
+
+        solved, total_time_ms = 0, 0
+        if not inserted:
+            if not Submissions.beats(attempt, best):
+                return best
+            if best.is_solved:
+                solved, total_time_ms = -1, -round(best.elapsed_time * 1000)
+            for key, value in values.items():
+                setattr(best, key, value)
+            session.add(best)
+        if attempt.is_solved:
+            solved += 1
+            total_time_ms += round(attempt.elapsed_time * 1000)
+        if attempt.contest_id is not None and (solved or total_time_ms):
+            await Standings.apply(
+                session, attempt.contest_id, attempt.username, solved, total_time_ms
+            )
+        return best
+
+    async def remove_duplicates(conn) -> int:
+        """Keep only the best row per problem and user. Older versions read
+        then inserted, so concurrent first attempts could both add one."""
+        duplicated = (await conn.execute(
+            select(Submissions.problem_id, Submissions.username)
+            .group_by(Submissions.problem_id, Submissions.username)
+            .having(func.count(Submissions.id) > 1)
+        )).all()
+        removed = 0
+        for problem_id, username in duplicated:
+            rows = (await conn.execute(
+                select(Submissions)
+                .where(
                     Submissions.problem_id == problem_id,
                     Submissions.username == username,
                 )
-            ).first()
-            return submission
+                .order_by(Submissions.id)
+            )).all()
+            best = rows[0]
+            for row in rows[1:]:
+                if Submissions.beats(row, best):
+                    best = row
+            removed += (await conn.execute(
+                Submissions.__table__.delete().where(
+                    Submissions.problem_id == problem_id,
+                    Submissions.username == username,
+                    Submissions.id != best.id,
+                )
+            )).rowcount
+        return removed
+
+    async def get_solved(username: str) -> list[int]:
+        async with new_session() as session:
+            return (await session.exec(
+                select(Submissions.problem_id).where(
+                    Submissions.username == username, Submissions.is_solved == True
+                )
+            )).all()
 
 
-def generate_code(string: str, table: SQLModel) -> str | None:
-    if not string.replace(" ", "").replace("-", "").isalnum():
-        return None
-    string = string.lower().replace(" ", "-")
-    if len(string) > 25:
-        string = string[:25]
+class Standings(SQLModel, table=True):
+    """Solved problems and their total time per contest and user, updated by
+    Submissions.record so the leaderboard never aggregates submissions."""
 
-    statement = select(table.code)
-    with Session(engine) as session:
-        codes = session.exec(statement).all()
+    __table_args__ = (UniqueConstraint("contest_id", "username"),)
 
-    if string not in codes:
-        return string
-    else:
-        for i in range(1, 100):
-            if f"{string}-{i}" not in codes:
-                return f"{string}-{i}"
-
-
-def init_db():
-    global engine
-    sqlite_file_name = "codeforge.db"
-    sqlite_url = f"sqlite:///{sqlite_file_name}"
-
-    new_db = True
-    if os.path.exists(sqlite_file_name):
-        new_db = False
-
-    engine = create_engine(sqlite_url, echo=True)
-
-    SQLModel.metadata.create_all(engine)
-
-    if new_db:
-        # try:
-        Users(username="admin").create()
-        with open("problems.json") as f:
-            problems_json = json.load(f)
-        print("Adding problems entries:", len(problems_json))
-        contest = Contests(
-            title="CodeForge 2024",
-            details="A platform for competitive programming",
-            owner="admin",
-        ).add()
-        for i, problem in enumerate(problems_json):
-            if i % 2 != 0:
-                contest_id = contest.id
-            else:
-                contest_id = None
-            new_problem = Problems(
-                title=problem["title"],
-                difficulty=problem["difficulty"],
-                problem_statement=problem["problem_statement"],
-                constraints=problem["constraints"],
-                owner="admin",
-                contest_id=contest_id,
+    id: int | None = Field(default=None, primary_key=True)
+    contest_id: int = Field(foreign_key="contests.id")
+    username: str = Field(foreign_key="users.username")
+    solved: int = 0
+    # Whole milliseconds, so ties compare exactly
+    total_time_ms: int = 0
+
+    async def apply(
+        session: AsyncSession,
+        contest_id: int,
+        username: str,
+        solved: int,
+        total_time_ms: int,
+    ):
+        statement = upsert(Standings).values(
+            contest_id=contest_id,
+            username=username,
+            solved=solved,
+            total_time_ms=total_time_ms,
+        )
+        await session.execute(
+            statement.on_conflict_do_update(
+                index_elements=["contest_id", "username"],
+                set_={
+                    "solved": Standings.solved + solved,
+                    "total_time_ms": Standings.total_time_ms + total_time_ms,
+                },
+            )
+        )
+
+    async def rank(session: AsyncSession, standing: "Standings") -> int:
+        """1 + the number of users ahead, ties share a rank."""
+        ahead = (await session.exec(
+            select(func.count(Standings.id)).where(
+                Standings.contest_id == standing.contest_id,
+                (Standings.solved > standing.solved)
+                | (
+                    (Standings.solved == standing.solved)
+                    & (Standings.total_time_ms < standing.total_time_ms)
+                ),
+            )
+        )).one()
+        return ahead + 1
+
+    async def get_page(contest_id: int, offset: int = 0, limit: int = 100):
+        """[(rank, standing)] of users who solved something, best first."""
+        async with new_session() as session:
+            standings = (await session.exec(
+                select(Standings)
+                .where(Standings.contest_id == contest_id, Standings.solved > 0)
+                .order_by(
+                    Standings.solved.desc(),
+                    Standings.total_time_ms,
+                    Standings.username,
+                )
+                .offset(offset)
+                .limit(limit)
+            )).all()
+            if not standings:
+                return []
+            # Only the first rank needs a count, the rest follow from the order
+            rank = await Standings.rank(session, standings[0])
+            page = []
+            for i, standing in enumerate(standings):
+                previous = standings[i - 1] if i else standing
+                if (standing.solved, standing.total_time_ms) != (
+                    previous.solved,
+                    previous.total_time_ms,
+                ):
+                    rank = offset + i + 1
+                page.append((rank, standing))
+            return page
+
+    async def get(contest_id: int, username: str):
+        """(rank, standing) of a user, None if they haven't solved anything."""
+        async with new_session() as session:
+            standing = (await session.exec(
+                select(Standings).where(
+                    Standings.contest_id == contest_id,
+                    Standings.username == username,
+                    Standings.solved > 0,
+                )
+            )).first()
+            if not standing:
+                return None
+            return await Standings.rank(session, standing), standing
+
+    async def get_many(contest_id: int, usernames):
+        """[(rank, standing)] of the users who solved something."""
+        async with new_session() as session:
+            standings = (await session.exec(
+                select(Standings).where(
+                    Standings.contest_id == contest_id,
+                    Standings.username.in_(usernames),
+                    Standings.solved > 0,
+                )
+            )).all()
+            return [
+                (await Standings.rank(session, standing), standing)
+                for standing in standings
+            ]
+
+    async def rebuild(conn):
+        """Fill the table from Submissions, when upgrading a database created
+        before it (see upgrade_db)."""
+        await conn.execute(
+            insert(Standings).from_select(
+                ["contest_id", "username", "solved", "total_time_ms"],
+                select(
+                    Submissions.contest_id,
+                    Submissions.username,
+                    func.count(Submissions.id),
+                    func.sum(
+                        cast(func.round(Submissions.elapsed_time * 1000), Integer)
+                    ),
+                )
+                .where(
+                    Submissions.contest_id.is_not(None),
+                    Submissions.is_solved == True,
+                )
+                .group_by(Submissions.contest_id, Submissions.username),
             )
-            if not new_problem.add():
-                raise Exception(f"Invalid title: {new_problem.title}")
-            new_problem.add_testcases(problem["testcases"])
-        # except Exception as e:
-        #     os.remove(sqlite_file_name)
-        #     raise Exception(f"Error while adding problems to the database: {e}")
+        )
+
+
+# Leaderboard pages are read in this order
+Index(
+    "ix_standings_rank",
+    Standings.contest_id,
+    Standings.solved.desc(),
+    Standings.total_time_ms,
+)
+
+
+class Jobs(SQLModel, table=True):
+    """A submission waiting for, or being judged by, a judge worker."""
+
+    id: int | None = Field(default=None, primary_key=True)
+    status: str = Field(default="queued", index=True)  # queued, running, done, failed
+    problem_id: int = Field(foreign_key="problems.id")
+    contest_id: int | None = Field(default=None, foreign_key="contests.id")
+    username: str = Field(foreign_key="users.username")
+    request: str  # RunRequest as JSON
+    fail_fast: bool = False
+    progress: str | None = None  # finished tests so far, {index: RunResponse} as JSON
+    result: str | None = None  # SubmitResult as JSON, or the error of a failed job
+    worker: str | None = None
+    created_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
+    started_at: datetime.datetime | None = None
+    heartbeat_at: datetime.datetime | None = None
+    finished_at: datetime.datetime | None = Field(default=None, index=True)
+
+    async def add(self):
+        async with new_session() as session:
+            session.add(self)
+            await session.commit()
+            await session.refresh(self)
+            return self
+
+    async def get(id: int):
+        async with new_session() as session:
+            return await session.get(Jobs, id)
+
+    async def count_queued() -> int:
+        async with new_session() as session:
+            return (await session.exec(
+                select(func.count(Jobs.id)).where(Jobs.status == "queued")
+            )).one()
+
+    async def position(self) -> int:
+        """1-based place in the queue, 0 once a worker picked it up."""
+        if self.status != "queued":
+            return 0
+        async with new_session() as session:
+            return (await session.exec(
+                select(func.count(Jobs.id)).where(
+                    Jobs.status == "queued", Jobs.id <= self.id
+                )
+            )).one()
+
+    async def claim(worker: str):
+        """Atomically take the oldest queued job, safe with many workers."""
+        async with new_session() as session:
+            while True:
+                job_id = (await session.exec(
+                    select(Jobs.id)
+                    .where(Jobs.status == "queued")
+                    .order_by(Jobs.id)
+                    .limit(1)
+                )).first()
+                if job_id is None:
+                    return None
+                now = datetime.datetime.now()
+                claimed = (await session.execute(
+                    update(Jobs)
+                    .where(Jobs.id == job_id, Jobs.status == "queued")
+                    .values(
+                        status="running", worker=worker, started_at=now, heartbeat_at=now
+                    )
+                )).rowcount
+                await session.commit()
+                if claimed:
+                    return await session.get(Jobs, job_id)
+
+    async def save_progress(self, progress: str | None = None):
+        async with new_session() as session:
+            values = {"heartbeat_at": datetime.datetime.now()}
+            if progress is not None:
+                values["progress"] = progress
+            await session.execute(update(Jobs).where(Jobs.id == self.id).values(**values))
+            await session.commit()
+
+    async def finish(self, status: str, result: str):
+        # The result has every test's output, the progress isn't needed anymore
+        async with new_session() as session:
+            await session.execute(
+                update(Jobs)
+                .where(Jobs.id == self.id)
+                .values(
+                    status=status,
+                    result=result,
+                    progress=None,
+                    finished_at=datetime.datetime.now(),
+                )
+            )
+            await session.commit()
+
+    async def requeue(self):
+        async with new_session() as session:
+            await session.execute(
+                update(Jobs)
+                .where(Jobs.id == self.id, Jobs.status == "running")
+                .values(status="queued", worker=None, progress=None)
+            )
+            await session.commit()
+
+    async def requeue_stale(max_age: float) -> int:
+        """Put back jobs whose worker stopped sending heartbeats."""
+        stale = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+        async with new_session() as session:
+            requeued = (await session.execute(
+                update(Jobs)
+                .where(Jobs.status == "running", Jobs.heartbeat_at < stale)
+                .values(status="queued", worker=None, progress=None)
+            )).rowcount
+            await session.commit()
+            return requeued
+
+    async def prune(max_age: float) -> int:
+        """Delete jobs finished more than max_age seconds ago."""
+        finished = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+        async with new_session() as session:
+            deleted = (await session.execute(
+                Jobs.__table__.delete().where(Jobs.finished_at < finished)
+            )).rowcount
+            await session.commit()
+            return deleted
+
+
+class SlugCounters(SQLModel, table=True):
+    """How many times a code was handed out per table, see generate_code."""
+
+    table_name: str = Field(primary_key=True)
+    slug: str = Field(primary_key=True)
+    count: int = 0
+
+
+async def claim_code(session: AsyncSession, table: SQLModel, slug: str) -> int:
+    """Count one more use of slug, returns how many uses there are now."""
+    statement = upsert(SlugCounters).values(
+        table_name=table.__tablename__, slug=slug, count=1
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=["table_name", "slug"],
+        set_={"count": SlugCounters.count + 1},
+    ).returning(SlugCounters.count)
+    return (await session.execute(statement)).scalar_one()
+
+
+async def generate_code(
+    session: AsyncSession, string: str, table: SQLModel
+) -> str | None:
+    """Unique code for a new row of table, claimed in the session's transaction.
+
+    The nth row titled "Two Sum" gets "two-sum-{n-1}" from its counter, without
+    reading the other codes. A numbered code is claimed too, so a title that
+    turns into it directly ("Two Sum 1") gets a different one. The counter row
+    stays locked until commit, so concurrent inserts can't get the same code.
+    """
+    if not string.replace(" ", "").replace("-", "").isalnum():
+        return None
+    slug = string.lower().replace(" ", "-")
+    if len(slug) > 25:
+        slug = slug[:25]
+
+    while True:
+        count = await claim_code(session, table, slug)
+        code = slug if count == 1 else f"{slug}-{count - 1}"
+        if count > 1 and await claim_code(session, table, code) > 1:
+            continue
+        # Rows added before the counters existed
+        taken = (await session.exec(select(table.id).where(table.code == code))).first()
+        if taken is None:
+            return code
+
+
+engine = None
+ready = False  # schema created and seeded, see init_db
+ready_lock = None
+# Time init_db took in this process, for /health
+setup_ms = None
+
+
+def upsert(table: SQLModel):
+    """INSERT supporting on_conflict_do_update for the engine's database."""
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+@contextlib.asynccontextmanager
+async def new_session():
+    # The database is set up by whichever query comes first
+    if not ready:
+        await init_db()
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        yield session
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets the API read while a judge worker writes
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+def create_indexes(conn, table):
+    # create_all skips the indexes of tables that already exist
+    for index in table.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def create_engine():
+    if config.DATABASE_URL.startswith("sqlite"):
+        engine = create_async_engine(config.DATABASE_URL, echo=config.DB_ECHO)
+        event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+        return engine
+    return create_async_engine(
+        config.DATABASE_URL,
+        echo=config.DB_ECHO,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+    )
+
+
+@contextlib.asynccontextmanager
+async def setup_lock():
+    """Processes starting together (the API, judge workers) set the database
+    up one at a time, the later ones then find it ready."""
+    database = engine.url.database
+    if engine.dialect.name == "sqlite" and database not in (None, "", ":memory:"):
+        with open(f"{database}.lock", "w") as f:
+            await asyncio.to_thread(fcntl.flock, f, fcntl.LOCK_EX)
+            yield
+    elif engine.dialect.name == "postgresql":
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT pg_advisory_lock(20240001)"))
+            try:
+                yield
+            finally:
+                await conn.execute(text("SELECT pg_advisory_unlock(20240001)"))
+    else:
+        yield
+
+
+def copy_snapshot():
+    """Start a new SQLite database from config.DB_SNAPSHOT (see api.seed)."""
+    path = engine.url.database
+    if not config.DB_SNAPSHOT or engine.dialect.name != "sqlite" or not path:
+        return
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        return
+    shutil.copyfile(config.DB_SNAPSHOT, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+    print("Database copied from snapshot:", config.DB_SNAPSHOT)
+
+
+def legacy_tables(conn) -> set[str]:
+    """Tables of an existing database still in an older layout, see upgrade_db."""
+    inspector = inspect(conn)
+    tables = set(inspector.get_table_names())
+    legacy = set()
+    if "testcases" in tables:
+        columns = {column["name"] for column in inspector.get_columns("testcases")}
+        if "input_hash" not in columns:
+            legacy.add("testcases")
+    if "submissions" in tables and "standings" not in tables:
+        legacy.add("submissions")
+    return legacy
+
+
+async def upgrade_db(conn, legacy: set[str]):
+    """Move the data of legacy tables to the current schema, in init_db's
+    transaction so an interrupted upgrade is simply run again.
+
+    Testcases kept their input and output in the table, they go to the blob
+    store. The old table was renamed to testcases_legacy before create_all.
+    Submissions could have several rows per problem and user, only the best
+    is kept before the indexes this version added, the unique one included,
+    and the contest standings are computed from what's left.
+    """
+    if "testcases" in legacy:
+        moved, last_id = 0, 0
+        while True:
+            rows = (await conn.execute(
+                text(
+                    "SELECT id, input, output, problem_id FROM testcases_legacy"
+                    " WHERE id > :last_id ORDER BY id LIMIT 500"
+                ),
+                {"last_id": last_id},
+            )).all()
+            if not rows:
+                break
+            # Same order, so the samples stay the first testcases of each problem
+            await conn.execute(insert(TestCases), [
+                TestCases.from_dict({"input": input, "output": output}, problem_id)
+                for _, input, output, problem_id in rows
+            ])
+            moved += len(rows)
+            last_id = rows[-1].id
+        await conn.execute(text("DROP TABLE testcases_legacy"))
+        print("Testcases moved to the blob store:", moved)
+    if "submissions" in legacy:
+        removed = await Submissions.remove_duplicates(conn)
+        # Unique on problem and user, so only once the duplicates are gone
+        await conn.run_sync(create_indexes, Submissions.__table__)
+        await Standings.rebuild(conn)
+        print("Duplicate submissions removed:", removed)
+
+
+async def seed(session: AsyncSession) -> int:
+    """The admin user, a contest and problems.json, in the caller's transaction."""
+    from api.importer import import_problems
+
+    session.add(Users(username="admin"))
+    contest = Contests(
+        title="CodeForge 2024",
+        details="A platform for competitive programming",
+        owner="admin",
+        date=datetime.date.today(),
+    )
+    contest.code = await generate_code(session, contest.title, Contests)
+    session.add(contest)
+    await session.flush()
+    # Every other problem goes to the contest
+    return await import_problems(
+        "problems.json",
+        "admin",
+        lambda i: contest.id if i % 2 != 0 else None,
+        session=session,
+    )
+
+
+async def close_db():
+    global engine, ready, ready_lock
+    if engine:
+        await engine.dispose()
+    engine, ready, ready_lock = None, False, None
+
+
+async def init_db():
+    """Create the schema and seed a new database, once per process. Safe to
+    call any number of times, from any number of processes."""
+    global engine, ready, ready_lock, setup_ms
+    if ready:
+        return
+    if ready_lock is None:
+        ready_lock = asyncio.Lock()
+    async with ready_lock:
+        if ready:
+            return
+        started_at = time.perf_counter()
+        if engine is None:
+            engine = create_engine()
+
+        async with setup_lock():
+            await asyncio.to_thread(copy_snapshot)
+            async with engine.begin() as conn:
+                legacy = await conn.run_sync(legacy_tables)
+                if "testcases" in legacy:
+                    await conn.execute(
+                        text("ALTER TABLE testcases RENAME TO testcases_legacy")
+                    )
+                await conn.run_sync(SQLModel.metadata.create_all)
+                if legacy:
+                    await upgrade_db(conn, legacy)
+
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                new_db = await session.get(Users, "admin") is None
+                if new_db:
+                    # All or nothing, an interrupted seed is simply run again
+                    count = await seed(session)
+                    await session.commit()
+                    print("Added problems entries:", count)
+
+        ready = True
+        setup_ms = round((time.perf_counter() - started_at) * 1000, 1)
+        print(f"Database ready in {setup_ms} ms")
@@ -1,7 +1,20 @@
+import asyncio
+import contextlib
+import json
+import os
+import time
+
 from pydantic import BaseModel
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from typing import List, Dict
 
+from api import config
+from api.backplane import backplane
+from api.catalog import catalog
+from api.http_cache import responses
+from api.metrics import stage_seconds, trace, websockets_dropped_total
+from api.models import Contests, Standings
+
 
 class ProblemDetails(BaseModel):
     title: str
@@ -29,6 +42,7 @@ class Error(BaseModel):
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, List[WebSocket]] = {}
+        self.closing = set()
 
     async def connect(self, websocket: WebSocket, contest_code: str):
         await websocket.accept()
@@ -37,19 +51,155 @@ class ConnectionManager:
         self.active_connections[contest_code].append(websocket)
 
     def disconnect(self, websocket: WebSocket, contest_code: str):
-        self.active_connections[contest_code].remove(websocket)
-        # if not self.active_connections[contest_code]:
-        #     del self.active_connections[contest_code]
+        # Slow or broken connections are already dropped by broadcast
+        connections = self.active_connections.get(contest_code, [])
+        if websocket in connections:
+            connections.remove(websocket)
+        if not connections:
+            self.active_connections.pop(contest_code, None)
+
+    def has_connections(self, contest_code: str) -> bool:
+        return bool(self.active_connections.get(contest_code))
 
     async def broadcast(self, contest_code: str, message: str):
-        if contest_code in self.active_connections:
-            print()
-            print(f"Broadcasting to {len(self.active_connections[contest_code])} connections")
-            print()
-            print()
-            for connection in self.active_connections[contest_code]:
-                
-                await connection.send_text(message)
-                
-
-manager = ConnectionManager()
\ No newline at end of file
+        """Send to every connection at once, so one slow client can't hold up
+        the others, and drop the ones that fail or time out."""
+        connections = list(self.active_connections.get(contest_code, []))
+        if not connections:
+            return
+        trace("Broadcasting to %d connections", len(connections))
+        with stage_seconds.time("broadcast"):
+            sent = await asyncio.gather(
+                *(self.send(connection, message) for connection in connections)
+            )
+        for connection, ok in zip(connections, sent):
+            if not ok:
+                websockets_dropped_total.inc()
+                self.disconnect(connection, contest_code)
+                # Keep a reference until done, the loop only holds weak ones
+                task = asyncio.create_task(self.close(connection))
+                self.closing.add(task)
+                task.add_done_callback(self.closing.discard)
+
+    async def send(self, websocket: WebSocket, message: str) -> bool:
+        try:
+            await asyncio.wait_for(websocket.send_text(message), config.WS_SEND_TIMEOUT)
+            return True
+        except Exception:
+            return False
+
+    async def close(self, websocket: WebSocket):
+        try:
+            await asyncio.wait_for(websocket.close(), config.WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+
+
+manager = ConnectionManager()
+
+
+async def invalidate_caches():
+    """Drop cached problems and contests here and in the other API processes."""
+    catalog.invalidate()
+    responses.invalidate()
+    try:
+        await backplane.publish({"type": "invalidate"})
+    except Exception as e:
+        print("Publishing cache invalidation failed:", e)
+
+
+def standing_entry(rank: int, standing: Standings) -> dict:
+    return {
+        "rank": rank,
+        "username": standing.username,
+        "solved_problems": standing.solved,
+        "total_time": standing.total_time_ms / 1000,
+    }
+
+
+# contest id -> usernames whose leaderboard rows haven't been sent yet
+changed_standings: dict[int, set[str]] = {}
+standings_changed = asyncio.Event()
+# job id -> queues of the streams following it, see api.routes.jobs
+job_watchers: dict[int, set[asyncio.Queue]] = {}
+
+
+@contextlib.contextmanager
+def watch_job(job_id: int):
+    """Queue of the job's messages from the judge workers while in the block."""
+    queue = asyncio.Queue()
+    job_watchers.setdefault(job_id, set()).add(queue)
+    try:
+        yield queue
+    finally:
+        watchers = job_watchers[job_id]
+        watchers.discard(queue)
+        if not watchers:
+            del job_watchers[job_id]
+
+
+async def handle_messages():
+    """Apply what judge workers and the other API processes publish on the
+    backplane: job progress, solved submissions and cache invalidations."""
+    while True:
+        try:
+            async for message in backplane.subscribe():
+                if message["type"] == "job_claimed":
+                    # Every job queued after it moves up
+                    for watchers in job_watchers.values():
+                        for queue in watchers:
+                            queue.put_nowait(message)
+                elif message["type"].startswith("job_"):
+                    for queue in job_watchers.get(message["job_id"], ()):
+                        queue.put_nowait(message)
+                elif message["type"] == "solved":
+                    catalog.mark_solved(message["username"], message["problem_id"])
+                    if message["contest_id"]:
+                        changed_standings.setdefault(message["contest_id"], set()).add(
+                            message["username"]
+                        )
+                        standings_changed.set()
+                elif message["type"] == "invalidate" and message["pid"] != os.getpid():
+                    catalog.invalidate()
+                    responses.invalidate()
+        except Exception as e:
+            print("Receiving backplane messages failed:", e)
+            await asyncio.sleep(1)
+
+
+async def broadcast_standings():
+    """Send contest pages the leaderboard rows of users who solved something,
+    at most once per BROADCAST_INTERVAL per contest."""
+    last_sent: dict[int, float] = {}
+    while True:
+        await standings_changed.wait()
+        standings_changed.clear()
+        while changed_standings:
+            now = time.monotonic()
+            next_at = min(
+                last_sent.get(contest_id, 0) + config.BROADCAST_INTERVAL
+                for contest_id in changed_standings
+            )
+            if next_at > now:
+                await asyncio.sleep(next_at - now)
+                continue
+            for contest_id in list(changed_standings):
+                if now - last_sent.get(contest_id, 0) < config.BROADCAST_INTERVAL:
+                    continue
+                usernames = changed_standings.pop(contest_id)
+                last_sent[contest_id] = now
+                try:
+                    code = await Contests.get_code(contest_id)
+                    if manager.has_connections(code):
+                        await manager.broadcast(
+                            code, await standings_update(contest_id, usernames)
+                        )
+                except Exception as e:
+                    print("Broadcasting standings failed:", e)
+
+
+async def standings_update(contest_id: int, usernames) -> str:
+    """Only the changed rows, clients merge them into the leaderboard they have."""
+    ranked = await Standings.get_many(contest_id, usernames)
+    rows = [standing_entry(rank, standing) for rank, standing in ranked]
+    return json.dumps({"type": "standings", "rows": rows})
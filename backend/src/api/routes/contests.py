@@ -1,8 +1,18 @@
-from fastapi import APIRouter, Response, WebSocket, WebSocketDisconnect, BackgroundTasks
+from fastapi import APIRouter, Request, Response, WebSocket, WebSocketDisconnect, BackgroundTasks
 from pydantic import BaseModel
 
-from api.models import Contests, Problems
-from api.routes import Error, ProblemDetails, ProblemList, manager
+from api.catalog import catalog
+from api.http_cache import responses
+from api.metrics import trace
+from api.models import Contests, Problems, Standings
+from api.routes import (
+    Error,
+    ProblemDetails,
+    ProblemList,
+    invalidate_caches,
+    manager,
+    standing_entry,
+)
 
 router = APIRouter(prefix="/contests")
 
@@ -14,40 +24,47 @@ class ContestPost(BaseModel):
 
 
 @router.get("/")
-def get_all_contests() -> list[Contests]:
-    return Contests.get_all()
+async def get_all_contests(request: Request) -> list[Contests]:
+    return await responses.respond(request, ("contests",), Contests.get_all)
 
 
 @router.post("/")
-def add_contest(contest: ContestPost, response: Response) -> Contests | Error:
+async def add_contest(contest: ContestPost, response: Response) -> Contests | Error:
     new_contest = Contests(
         title=contest.title,
         details=contest.details,
         owner=contest.owner,
     )
-    if not new_contest.add():
+    if not await new_contest.add():
         response.status_code = 400
         return Error(
             "Cannot add contest",
             "Invalid title: Only use alphanumeric characters and spaces, or try a different title.",
         )
+    await invalidate_caches()
     return new_contest
 
 
 @router.get("/{contest_code}")
-def get_contest(contest_code: str, response: Response) -> Contests | Error:
-    contest = Contests.get(contest_code)
-    if not contest:
+async def get_contest(
+    contest_code: str, request: Request, response: Response
+) -> Contests | Error:
+    cached = await responses.respond(
+        request,
+        ("contest", contest_code),
+        lambda: catalog.get_contest(contest_code),
+    )
+    if not cached:
         response.status_code = 404
         return Error("Contest not found", "Invalid contest code.")
-    return contest
+    return cached
 
 
 @router.post("/{contest_code}/problems")
-def add_contest_problem(
+async def add_contest_problem(
     contest_code: str, problems: list[ProblemDetails], response: Response
 ):
-    contest = Contests.get(contest_code)
+    contest = await catalog.get_contest(contest_code)
     if not contest:
         response.status_code = 404
         return Error("Contest not found", "Invalid contest code.")
@@ -68,39 +85,37 @@ def add_contest_problem(
             owner=problem.owner,
             contest_id=contest.id,
         )
-        if not new_problem.add():
-            response.status_code = 400
-            return Error(
-                "Cannot add problem",
-                "Invalid title: Only use alphanumeric characters and spaces, or try a different title.",
-            )
-        try:
-            new_problem.add_testcases(problem.testcases)
-        except KeyError:
-            response.status_code = 400
-            return Error(
-                "Cannot add testcases to problem",
-                "Invalid testcases: Each testcase must have 'input' and 'output' keys.",
-            )
-        all_new_problems.append(new_problem)
+        all_new_problems.append((new_problem, problem.testcases))
+
+    # All problems are added together, or none of them
+    try:
+        added = await Problems.add_all(all_new_problems)
+    except KeyError:
+        response.status_code = 400
+        return Error(
+            "Cannot add testcases to problem",
+            "Invalid testcases: Each testcase must have 'input' and 'output' keys.",
+        )
+    if added is None:
+        response.status_code = 400
+        return Error(
+            "Cannot add problem",
+            "Invalid title: Only use alphanumeric characters and spaces, or try a different title.",
+        )
 
-    return all_new_problems
+    await invalidate_caches()
+    return added
 
 
 @router.get("/{contest_code}/problems")
-def get_contest_problems(contest_code: str, username: str, response: Response):
-    contest = Contests.get(contest_code)
-    print("Contest :", contest)
+async def get_contest_problems(contest_code: str, username: str, response: Response):
+    contest = await catalog.get_contest(contest_code)
     if not contest:
         response.status_code = 404
         return Error("Contest not found", "Invalid contest code.")
-    problems = contest.get_problems(username)
-    if not problems:
-        return []
+    problems = await catalog.get_problems(contest.id, username)
     problems_info = []
     for problem, is_solved in problems:
-        if is_solved is None:
-            is_solved = False
         problems_info.append(
             ProblemList(
                 code=problem.code,
@@ -113,35 +128,37 @@ def get_contest_problems(contest_code: str, username: str, response: Response):
 
 
 @router.get("/{contest_code}/leaderboard")
-def get_contest_leaderboard(contest_code: str, response: Response) -> list[dict] | Error:
-    contest = Contests.get(contest_code)
+async def get_contest_leaderboard(
+    contest_code: str, response: Response, offset: int = 0, limit: int = 100
+) -> list[dict] | Error:
+    contest = await catalog.get_contest(contest_code)
+    if not contest:
+        response.status_code = 404
+        return Error("Contest not found", "Invalid contest code.")
+
+    limit = min(max(limit, 1), 1000)
+    page = await Standings.get_page(contest.id, max(offset, 0), limit)
+    return [standing_entry(rank, standing) for rank, standing in page]
+
+
+@router.get("/{contest_code}/leaderboard/{username}")
+async def get_contest_rank(contest_code: str, username: str, response: Response):
+    contest = await catalog.get_contest(contest_code)
     if not contest:
         response.status_code = 404
         return Error("Contest not found", "Invalid contest code.")
-    
-    leaderboard = Contests.get_leaderboard(contest.id)
-    if not leaderboard:
-        # response.status_code = 404
-        # return Error("Leaderboard not found", "No submissions found for this contest.")
-        return []
-
-    return [
-        {
-            "username": entry.username,
-            "solved_problems": entry.solved_problems,
-            "total_time": entry.total_time
-        }
-        for entry in leaderboard
-    ]
+
+    ranked = await Standings.get(contest.id, username)
+    if not ranked:
+        response.status_code = 404
+        return Error("Not ranked", "No solved problems in this contest yet.")
+    return standing_entry(*ranked)
+
 
 @router.websocket("/ws/{contest_code}")
 async def websocket_endpoint(websocket: WebSocket, contest_code: str):
     await manager.connect(websocket, contest_code)
-    print()
-    print()
-    print(f"Connected to {contest_code}")
-    print()
-    print()
+    trace("Websocket connected to %s", contest_code)
     try:
         while True:
             data = await websocket.receive_text()
@@ -0,0 +1,120 @@
+import asyncio
+import json
+
+from fastapi import APIRouter, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from api import config
+from api.judge import SubmitResult
+from api.models import Jobs
+from api.routes import Error, watch_job
+from api.routes.run import RunResponse
+
+router = APIRouter(prefix="/jobs")
+
+
+class JobStatus(BaseModel):
+    id: int
+    status: str
+    position: int
+    # Tests finished so far, by index
+    results: dict[int, RunResponse] = {}
+    result: SubmitResult | None = None
+    error: str | None = None
+
+
+async def job_status(job: Jobs) -> JobStatus:
+    return JobStatus(
+        id=job.id,
+        status=job.status,
+        position=await job.position(),
+        results=json.loads(job.progress) if job.progress else {},
+        result=(
+            SubmitResult.model_validate_json(job.result)
+            if job.status == "done"
+            else None
+        ),
+        error=json.loads(job.result)["error"] if job.status == "failed" else None,
+    )
+
+
+def test_event(index: int, result: dict) -> str:
+    return f"event: test\ndata: {json.dumps({'index': index, **result})}\n\n"
+
+
+async def job_events(job_id: int):
+    """Server-sent events for a job: "position" while queued, "test" for every
+    finished test, then "result" (or "error" if judging failed).
+
+    Judge workers publish each finished test on the backplane as it happens.
+    The job is read from the database when the stream starts, so a client that
+    reconnects gets what it missed, then only for the result, or when nothing
+    arrived for JOB_STALE_SECONDS in case a message was dropped."""
+    position, sent = None, set()
+    with watch_job(job_id) as messages:
+        # Watching first, a test finishing meanwhile is in both and sent once
+        job = await Jobs.get(job_id)
+        while True:
+            if job:
+                status = await job_status(job)
+                if status.position != position:
+                    position = status.position
+                    yield f"event: position\ndata: {position}\n\n"
+                results = status.results
+                if status.result:
+                    # Tests whose message was dropped or came after the end
+                    results = dict(enumerate(status.result.results))
+                for index, result in sorted(results.items()):
+                    if index not in sent and result.message != "Skipped":
+                        sent.add(index)
+                        yield test_event(index, result.model_dump())
+                if status.result:
+                    yield f"event: result\ndata: {status.result.model_dump_json()}\n\n"
+                    return
+                if status.error:
+                    yield f"event: error\ndata: {json.dumps(status.error)}\n\n"
+                    return
+                job = None
+
+            try:
+                message = await asyncio.wait_for(
+                    messages.get(), config.JOB_STALE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                job = await Jobs.get(job_id)
+                continue
+            if message["type"] == "job_claimed":
+                # Jobs are claimed in id order, each one ahead moves this one up
+                if message["job_id"] == job_id:
+                    new_position = 0
+                elif message["job_id"] < job_id and position:
+                    new_position = max(position - 1, 1)
+                else:
+                    continue
+                if new_position != position:
+                    position = new_position
+                    yield f"event: position\ndata: {position}\n\n"
+            elif message["type"] == "job_test":
+                if message["index"] not in sent:
+                    sent.add(message["index"])
+                    yield test_event(message["index"], message["result"])
+            elif message["type"] == "job_finished":
+                job = await Jobs.get(job_id)
+
+
+@router.get("/{job_id}")
+async def get_job(job_id: int, response: Response) -> JobStatus | Error:
+    job = await Jobs.get(job_id)
+    if not job:
+        response.status_code = 404
+        return Error("Job not found", "Invalid job id.")
+    return await job_status(job)
+
+
+@router.get("/{job_id}/stream")
+async def stream_job(job_id: int, response: Response):
+    if not await Jobs.get(job_id):
+        response.status_code = 404
+        return Error("Job not found", "Invalid job id.")
+    return StreamingResponse(job_events(job_id), media_type="text/event-stream")
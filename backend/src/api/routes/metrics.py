@@ -0,0 +1,25 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from api import metrics
+
+router = APIRouter(prefix="/metrics")
+
+
+@router.get("", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@router.get("/trace")
+def get_tracing() -> dict:
+    return {"enabled": metrics.tracing}
+
+
+@router.put("/trace")
+def set_tracing(enabled: bool) -> dict:
+    """Switch verbose tracing of runs on or off in every process."""
+    metrics.set_tracing(enabled)
+    return {"enabled": metrics.tracing}
@@ -1,22 +1,19 @@
-from fastapi import APIRouter, BackgroundTasks, Response
-from pydantic import BaseModel
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import StreamingResponse
 
-from api.models import Contests, Problems, Submissions, TestCases
-from api.routes import Error, ProblemDetails, ProblemList, manager
-from api.routes.run import RunRequest, RunResponse, run_code
+from api import config
+from api.catalog import catalog
+from api.http_cache import responses
+from api.models import Jobs, Problems, SubmissionLog, TestCases
+from api.routes import Error, ProblemDetails, ProblemList, invalidate_caches
+from api.routes.jobs import JobStatus, job_events, job_status
+from api.routes.run import RunRequest
 
 router = APIRouter(prefix="/problems")
 
-class SubmitResult(BaseModel):
-    is_solved: bool
-    total_passed: int
-    elapsed_time: float
-    memory_used: float
-    results: list[RunResponse]
-
 
 @router.post("/")
-def add_problem(problem: ProblemDetails, response: Response) -> Problems | Error:
+async def add_problem(problem: ProblemDetails, response: Response) -> Problems | Error:
     new_problem = Problems(
         title=problem.title,
         difficulty=problem.difficulty,
@@ -24,31 +21,30 @@ def add_problem(problem: ProblemDetails, response: Response) -> Problems | Error
         constraints=problem.constraints,
         owner=problem.owner,
     )
-    if not new_problem.add():
-        response.status_code = 400
-        return Error(
-            "Cannot add problem",
-            "Invalid title: Only use alphanumeric characters and spaces, or try a different title.",
-        )
     try:
-        new_problem.add_testcases(problem.testcases)
+        added = await Problems.add_all([(new_problem, problem.testcases)])
     except KeyError:
         response.status_code = 400
         return Error(
             "Cannot add testcases to problem",
             "Invalid testcases: Each testcase must have 'input' and 'output' keys.",
         )
+    if not added:
+        response.status_code = 400
+        return Error(
+            "Cannot add problem",
+            "Invalid title: Only use alphanumeric characters and spaces, or try a different title.",
+        )
 
+    await invalidate_caches()
     return new_problem
 
 
 @router.get("/")
-def get_all_problems(username: str) -> list[ProblemList]:
-    problems = Problems.get_all(username)
+async def get_all_problems(username: str) -> list[ProblemList]:
+    problems = await catalog.get_problems(None, username)
     problems_info = []
     for problem, is_solved in problems:
-        if is_solved is None:
-            is_solved = False
         problems_info.append(
             ProblemList(
                 code=problem.code,
@@ -61,29 +57,57 @@ def get_all_problems(username: str) -> list[ProblemList]:
 
 
 @router.get("/{problem_code}")
-def get_problem(problem_code: str, response: Response) -> ProblemDetails | Error:
-    problem = Problems.get(problem_code)
+async def get_problem(
+    problem_code: str,
+    request: Request,
+    response: Response,
+    offset: int = 0,
+    limit: int = config.SAMPLE_TESTS,
+) -> ProblemDetails | Error:
+    """The problem with a page of its sample testcases."""
+    offset, limit = max(offset, 0), max(limit, 0)
+
+    async def build():
+        problem = await Problems.get(problem_code)
+        if not problem:
+            return None
+        testcases = await TestCases.get_samples(problem.id, offset, limit)
+        return ProblemDetails(
+            title=problem.title,
+            difficulty=problem.difficulty,
+            problem_statement=problem.problem_statement,
+            constraints=problem.constraints,
+            testcases=[t.to_dict() for t in testcases],
+            owner=problem.owner,
+        )
+
+    cached = await responses.respond(
+        request, ("problem", problem_code, offset, limit), build
+    )
+    if not cached:
+        response.status_code = 404
+        return Error("Problem not found", "Invalid problem code.")
+    return cached
+
+
+@router.get("/{problem_code}/submissions")
+async def get_submissions(
+    problem_code: str, username: str, response: Response, offset: int = 0, limit: int = 50
+):
+    """A user's attempts at the problem, newest first."""
+    problem = await Problems.get(problem_code)
     if not problem:
         response.status_code = 404
         return Error("Problem not found", "Invalid problem code.")
-    testcases = TestCases.get(problem.id)
-    return ProblemDetails(
-        title=problem.title,
-        difficulty=problem.difficulty,
-        problem_statement=problem.problem_statement,
-        constraints=problem.constraints,
-        testcases=[{"input": t.input, "output": t.output} for t in testcases],
-        owner=problem.owner,
+    history = await SubmissionLog.get_history(
+        problem.id, username, max(offset, 0), min(max(limit, 1), 500)
     )
+    return [dict(attempt._mapping) for attempt in history]
 
 
-@router.post("/{problem_code}/submit")
-async def submit_problem(
-    problem_code: str,
-    run_req: RunRequest,
-    response: Response,
-    background_tasks: BackgroundTasks,
-) -> SubmitResult | Error:
+async def enqueue_submission(
+    problem_code: str, run_req: RunRequest, response: Response, fail_fast: bool
+) -> Jobs | Error:
     if run_req.username is None:
         response.status_code = 403
         return Error(
@@ -91,63 +115,53 @@ async def submit_problem(
             "You can't submit the solution, please login.",
         )
 
-    problem = Problems.get(problem_code)
+    problem = await Problems.get(problem_code)
     if not problem:
         response.status_code = 404
         return Error("Problem not found", "Invalid problem code.")
 
-    testcases = TestCases.get(problem.id)
-    all_results = []
-    total_passed, total_elapsed_time, total_memory_used = 0, 0, 0
-    for testcase in testcases:
-        run_req.input_data = testcase.input
-        result = run_code(run_req)
-        if result.message == "Success":
-            if result.stdout.strip("\n ") == testcase.output.strip("\n "):
-                result.test_passed = True
-                total_passed += 1
-            total_elapsed_time += result.elapsed_time
-            total_memory_used += result.memory_usage
-        all_results.append(result)
-
-    is_solved = total_passed == len(testcases)
-
-    submission = Submissions.get(problem.id, run_req.username)
-    if not submission:
-        submission = Submissions(
-            problem_id=problem.id,
-            contest_id=problem.contest_id,
-            username=run_req.username,
-            is_solved=is_solved,
-            total_passed=total_passed,
-            elapsed_time=total_elapsed_time,
-            memory_used=total_memory_used,
+    queued = await Jobs.count_queued()
+    if queued >= config.MAX_QUEUED_JOBS:
+        response.status_code = 429
+        response.headers["Retry-After"] = "5"
+        return Error(
+            "Too many submissions",
+            f"{queued} submissions are waiting to be judged, try again later.",
         )
-    elif not is_solved and submission.total_passed < total_passed:
-        submission.is_solved = is_solved
-        submission.total_passed = total_passed
-        submission.elapsed_time = total_elapsed_time
-        submission.memory_used = total_memory_used
-    elif is_solved and submission.elapsed_time > total_elapsed_time:
-        submission.is_solved = is_solved
-        submission.total_passed = total_passed
-        submission.elapsed_time = total_elapsed_time
-        submission.memory_used = total_memory_used
-    submission.add()
-
-    if problem.contest_id:
-        contest_code = Contests.get_code(problem.contest_id)
-        # Add the broadcast to the background tasks
-        # background_tasks.add_task(manager.broadcast, problem.contest_id, "reload")
-        print("Sending message")
-        await manager.broadcast(contest_code, "reload")
-        print("Message sent")
-
-    return SubmitResult(
-        is_solved=is_solved,
-        total_passed=total_passed,
-        elapsed_time=total_elapsed_time,
-        memory_used=total_memory_used,
-        results=all_results,
-    )
 
+    return await Jobs(
+        problem_id=problem.id,
+        contest_id=problem.contest_id,
+        username=run_req.username,
+        request=run_req.model_dump_json(),
+        fail_fast=fail_fast,
+    ).add()
+
+
+@router.post("/{problem_code}/submit", status_code=202)
+async def submit_problem(
+    problem_code: str,
+    run_req: RunRequest,
+    response: Response,
+    fail_fast: bool = False,
+) -> JobStatus | Error:
+    """Queue the submission for the judge workers, poll /jobs/{id} for the result."""
+    job = await enqueue_submission(problem_code, run_req, response, fail_fast)
+    if isinstance(job, Error):
+        return job
+    return await job_status(job)
+
+
+@router.post("/{problem_code}/submit/stream")
+async def submit_problem_stream(
+    problem_code: str,
+    run_req: RunRequest,
+    response: Response,
+    fail_fast: bool = False,
+):
+    """Same as submit, but streams the job's progress as server-sent events,
+    see api.routes.jobs.job_events."""
+    job = await enqueue_submission(problem_code, run_req, response, fail_fast)
+    if isinstance(job, Error):
+        return job
+    return StreamingResponse(job_events(job.id), media_type="text/event-stream")
@@ -1,16 +1,32 @@
+import asyncio
+import contextlib
+import functools
+import math
 import os
 import resource
-import shutil
-import subprocess
-import tempfile
-import threading
 import time
 import traceback
 from enum import Enum
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Response
 from pydantic import BaseModel
 
+from api import config
+from api.blobstore import Blob
+from api.compile_cache import CompileCache
+from api.metrics import runs_total, stage_seconds, trace
+from api.pch import PrecompiledHeaders
+from api.routes import Error
+from api.sandbox import (
+    OutputCapture,
+    OutputMatcher,
+    SandboxProcess,
+    SandboxSlots,
+    peak_rss_helper,
+)
+from api.warm_pool import WARM_BOOTSTRAP, WarmPool, WarmWorker
+from api.workspace import workspaces
+
 router = APIRouter(prefix="/run")
 
 
@@ -23,6 +39,37 @@ class Language(Enum):
 
 COMPILED = {Language.C, Language.CPP}
 
+COMPILERS = {
+    Language.C: "/bin/gcc",
+    Language.CPP: "/bin/g++",
+}
+
+COMPILE_FLAGS = {
+    Language.C: config.C_FLAGS,
+    Language.CPP: config.CPP_FLAGS,
+}
+
+precompiled_headers = {
+    language: PrecompiledHeaders(
+        config.PCH_DIR, language.value, COMPILERS[language], COMPILE_FLAGS[language], headers
+    )
+    for language, headers in (
+        (Language.C, config.C_PCH_HEADERS),
+        (Language.CPP, config.CPP_PCH_HEADERS),
+    )
+    if headers
+}
+
+compile_cache = None
+if config.COMPILE_CACHE_MAX_BYTES > 0:
+    compile_cache = CompileCache(
+        config.COMPILE_CACHE_DIR, config.COMPILE_CACHE_MAX_BYTES
+    )
+
+# Every sandbox spawn takes a slot, so bursts can't oversubscribe the machine,
+# shared with the other API and judge worker processes
+sandbox_slots = SandboxSlots(config.SANDBOX_SLOTS_DIR, config.SANDBOX_WORKERS)
+
 
 class RunRequest(BaseModel):
     source_code: str
@@ -35,172 +82,410 @@ class RunResponse(BaseModel):
     stdout: str = ""
     stderr: str = ""
     return_code: int | None = None
-    elapsed_time: float | None = None
-    memory_usage: float | None = None
+    elapsed_time: float | None = None  # CPU time in seconds
+    memory_usage: float | None = None  # peak RSS in MB
+    cpu_time_us: int | None = None
+    wall_time_us: int | None = None
     timeout: bool = False
+    output_limit_exceeded: bool = False
     test_passed: bool = False
     message: str
 
 
-@router.post("/")
-def run_code(request_data: RunRequest) -> RunResponse:
-    source_code = request_data.source_code
-    input_data = request_data.input_data
-    language = request_data.language
-
-    # save tmp file
-    tempdir = tempfile.mkdtemp(prefix="codeforge_")
-    with open(os.path.join(tempdir, f"main.{language.value}"), "w") as f:
-        print(source_code)
-        f.write(source_code)
-        file_name = f.name
-        # f.flush()
-
-    print(file_name)
-    if language == Language.PYTHON:
-        command = ["/bin/python3", file_name]
-    elif language == Language.C:
-        command = ["/bin/gcc", file_name, "-o", f"{file_name}.out", "-lm"]
-    elif language == Language.CPP:
-        command = [
-            "/bin/g++",
-            "-I/usr/include/c++/13",
-            "-I/usr/include/c++/13/x86_64-suse-linux",
-            file_name,
-            "-o",
-            f"{file_name}.out",
-        ]
-    elif language == Language.JAVASCRIPT:
-        command = ["/bin/node", file_name]
-    else:
-        return RunResponse(message="Invalid language")
+class Program:
+    def __init__(self, source_code: str, language: Language):
+        self.source_code = source_code
+        self.language = language
+        self.tempdir = None
+        self.command = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+    async def compile(self) -> RunResponse | None:
+        """Write the source and compile it if needed.
+
+        Returns a RunResponse describing the failure, or None once the program
+        is ready to be run against any number of inputs.
+        """
+        language = self.language
+        if language in warm_pools:
+            # The source is written into a warm worker's workspace on every run
+            return
+
+        # save tmp file
+        with stage_seconds.time("workspace"):
+            self.tempdir = workspaces.lease()
+        with open(os.path.join(self.tempdir, f"main.{language.value}"), "w") as f:
+            f.write(self.source_code)
+            file_name = f.name
+        trace("Source %s:\n%s", file_name, self.source_code)
+
+        if language == Language.PYTHON:
+            self.command = ["/bin/python3", file_name]
+        elif language == Language.JAVASCRIPT:
+            self.command = ["/bin/node", file_name]
+        elif language not in COMPILED:
+            return RunResponse(message="Invalid language")
+
+        if language in COMPILED:
+            binary = f"{file_name}.out"
+            flags = COMPILE_FLAGS[language]
+            self.command = [binary]
+
+            cache_key = None
+            if compile_cache:
+                cache_key = CompileCache.key(self.source_code, language.value, flags)
+                if compile_cache.get(cache_key, binary):
+                    return
+
+            pch_flags, read_only = [], []
+            if language in precompiled_headers:
+                pch_flags = precompiled_headers[language].compile_flags()
+                if pch_flags:
+                    read_only = [precompiled_headers[language].directory]
+            # Ahead of the flags, so the headers' directory is searched first
+            command = [COMPILERS[language], file_name, "-o", binary, *pch_flags, *flags]
+            with stage_seconds.time("compile"):
+                result = await run_command(
+                    command, None, self.tempdir, read_only=read_only
+                )
+            if result.message:
+                return RunResponse(message=result.message)
+
+            if result.timeout:
+                result.message = "Time limit exceeded"
+                return result
+            if result.return_code != 0:
+                result.message = "Compilation error"
+                return result
+
+            if cache_key:
+                compile_cache.put(cache_key, binary)
+
+    async def run(
+        self,
+        input_data: str | Blob | None,
+        expected_output: str | Blob | None = None,
+    ) -> RunResponse:
+        """Blob inputs are fed to the sandbox straight from their file, and
+        Blob expected outputs compared through a memory map."""
+        if self.language in warm_pools:
+            result = await self.run_warm(input_data, expected_output)
+        else:
+            result = await run_command(
+                self.command, input_data, self.tempdir, expected_output=expected_output
+            )
 
-    if language in COMPILED:
-        result = run_command(command, input_data, tempdir)
         if result.message:
+            runs_total.inc(self.language.value, "Server error")
             return RunResponse(message=result.message)
 
         if result.timeout:
             result.message = "Time limit exceeded"
-            return result
-        if result.return_code != 0:
-            result.message = "Compilation error"
-            return result
+        elif result.output_limit_exceeded:
+            result.message = "Output limit exceeded"
+        elif result.return_code != 0:
+            result.message = "Runtime error"
+        elif result.return_code is None:
+            result.message = "Server error"
+        else:
+            result.message = "Success"
+        if result.message != "Success":
+            result.test_passed = False
+        runs_total.inc(self.language.value, result.message)
+        return result
+
+    async def run_warm(
+        self,
+        input_data: str | Blob | None,
+        expected_output: str | Blob | None = None,
+        timeout=5,
+    ) -> RunResponse:
+        with stage_seconds.time("workspace"):
+            worker = await warm_pools[self.language].acquire()
+        try:
+            file_name = f"main.{self.language.value}"
+            with open(os.path.join(worker.workspace, file_name), "w") as f:
+                f.write(self.source_code)
+
+            async with sandbox_slots:
+                with contextlib.ExitStack() as stack:
+                    # The worker's stdin is already a pipe, a Blob input is
+                    # written into it from a memory map
+                    if isinstance(input_data, Blob):
+                        input_data = stack.enter_context(input_data.mapped())
+                    elif input_data is not None:
+                        input_data = input_data.encode()
+                    expected = open_expected_output(stack, expected_output)
+                    # The worker reads the file name line, the rest of stdin is the program's
+                    return await collect_output(
+                        worker.process,
+                        [f"{file_name}\n".encode(), input_data or b""],
+                        timeout,
+                        # Wall time starts at the hand-off, not when the worker was started
+                        started_at=time.perf_counter(),
+                        expected_output=expected,
+                    )
+        finally:
+            await worker.release()
+
+    async def run_all(
+        self, inputs: list[str | None], timeout: float | None = None
+    ) -> list[RunResponse]:
+        """Run the program against every input concurrently, results keep input order.
+
+        Runs still going (or waiting for a sandbox) after timeout seconds are
+        killed and reported as "Skipped".
+        """
+        tasks = [asyncio.create_task(self.run(input_data)) for input_data in inputs]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=timeout)
+        finally:
+            for task in tasks:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return [
+            task.result() if task in done else RunResponse(message="Skipped")
+            for task in tasks
+        ]
 
-        command = [f"{file_name}.out"]
+    def cleanup(self):
+        if self.tempdir:
+            workspaces.release(self.tempdir)
+            self.tempdir = None
 
-    result = run_command(command, input_data, tempdir)
-    # os.remove(file_name)
-    shutil.rmtree(tempdir)
 
-    if result.message:
-        return RunResponse(message=result.message)
+@router.on_event("startup")
+def build_precompiled_headers():
+    """Build the headers that aren't yet, in the background."""
+    for headers in precompiled_headers.values():
+        if not headers.is_ready():
+            headers.start_build()
 
-    if result.timeout:
-        result.message = "Time limit exceeded"
-    elif result.return_code != 0:
-        result.message = "Runtime error"
-    elif result.return_code is None:
-        result.message = "Server error"
-    else:
-        result.message = "Success"
-    return result
 
+@router.on_event("shutdown")
+async def close_warm_pools():
+    for pool in warm_pools.values():
+        await pool.close()
 
-def run_command(command, input_string, tempdir, timeout=5, memory_limit=1000):
-    def target(command, input_string):
-        try:
-            print(tempdir)
-            nsjail_cmd = f"nsjail -Mo -q --user 99999 --group 99999 --rlimit_as {memory_limit} --time_limit {timeout} -R /bin/ -R /lib/ -R /lib64/ -R /usr/ -R /etc/alternatives/ -B {tempdir} -D {tempdir} --keep_env --".split()
-            time_cmd = ["/bin/time", "-a", "-f", "%E %M", "--"]
-            # time_cmd = "/bin/time -a -f %E %M --"
-            # command = ' '.join(command)
-
-            command = nsjail_cmd + time_cmd + command
-            # command = time_cmd + command
-            print("Command: ", command)
-
-            # start_time = time.time()
-            process = subprocess.Popen(
-                command,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                # preexec_fn=lambda: resource.setrlimit(
-                #     resource.RLIMIT_AS, (max_memory, max_memory)
-                # ),
-            )
 
-            stdout, stderr = process.communicate(input=input_string, timeout=timeout)
-            # end_time = time.time()
-            split_stderr = stderr.splitlines()
-            if len(split_stderr) > 1:
-                stderr, time_output = "\n".join(split_stderr[:-1]), split_stderr[-1]
-            else:
-                stderr, time_output = "", stderr
-
-            # Elapsed real time (in [hours:]minutes:seconds).
-            # Maximum resident set size of the process during its lifetime, in Kilobytes.
-
-            print("Stdout: ", stdout)
-            print("Stderr: ", stderr)
-            print("Time output: ", time_output)
-            elapsed_time, memory_usage = time_output.split()
-            elapsed_time = time_to_seconds(elapsed_time)
-            memory_usage = int(memory_usage)
-
-            # elapsed_time = end_time - start_time
-            # memory_usage = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
-
-            if process.returncode == 137:
-                result.timeout = True
-
-            result.stdout = stdout
-            result.stderr = stderr
-            result.return_code = process.returncode
-            result.elapsed_time = round(elapsed_time, 3)
-            result.memory_usage = round(memory_usage / 1024, 3)  # in MB
-        except subprocess.TimeoutExpired:
-            process.kill()
-            result.timeout = True
-        except Exception as e:
-            traceback.print_exc()
-            result.message = str(e)
+@router.get("/cache")
+def get_compile_cache_stats() -> dict:
+    if not compile_cache:
+        return {}
+    return compile_cache.stats()
 
-    # max_memory = memory_limit * 1024 * 1024  # in MB
-    result = RunResponse(message="")
 
-    thread = threading.Thread(target=target, args=(command, input_string))
-    thread.start()
-    thread.join(timeout)
+@router.post("/")
+async def run_code(request_data: RunRequest) -> RunResponse:
+    with Program(request_data.source_code, request_data.language) as program:
+        error = await program.compile()
+        if error:
+            return error
+        return await program.run(request_data.input_data)
 
-    if thread.is_alive():
-        result.timeout = True
-        thread.join()  # Make sure thread finishes
 
-    return result
+class BatchRunRequest(BaseModel):
+    source_code: str
+    inputs: list[str | None]
+    language: Language
+    username: str | None = None
 
 
-def time_to_seconds(time_str):
-    parts = time_str.split(":")
+@router.post("/batch")
+async def run_batch(request_data: BatchRunRequest, response: Response) -> list[RunResponse] | Error:
+    """Compile once and run every input concurrently, all within RUN_BATCH_TIMEOUT
+    seconds. A compile error is the result of every input."""
+    inputs = request_data.inputs
+    if not inputs or len(inputs) > config.RUN_BATCH_MAX_INPUTS:
+        response.status_code = 400
+        return Error(
+            "Invalid inputs",
+            f"Give between 1 and {config.RUN_BATCH_MAX_INPUTS} inputs.",
+        )
+
+    deadline = time.monotonic() + config.RUN_BATCH_TIMEOUT
+    with Program(request_data.source_code, request_data.language) as program:
+        try:
+            error = await asyncio.wait_for(program.compile(), config.RUN_BATCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            error = RunResponse(timeout=True, message="Time limit exceeded")
+        if error:
+            return [error] * len(inputs)
+        return await program.run_all(inputs, max(deadline - time.monotonic(), 0))
+
+
+async def run_command(
+    command,
+    input_data: str | Blob | None,
+    tempdir,
+    timeout=5,
+    memory_limit=1000,
+    expected_output: str | Blob | None = None,
+    read_only: list[str] | None = None,
+):
+    async with sandbox_slots:
+        # Test data files are only opened once a sandbox slot is free
+        with contextlib.ExitStack() as stack:
+            stdin, input_bytes = None, None
+            try:
+                if isinstance(input_data, Blob):
+                    stdin = stack.enter_context(input_data.open())
+                elif input_data is not None:
+                    input_bytes = input_data.encode()
+                expected = open_expected_output(stack, expected_output)
+                process = spawn_sandbox(
+                    command, tempdir, timeout, memory_limit, stdin=stdin, read_only=read_only
+                )
+            except Exception as e:
+                traceback.print_exc()
+                return RunResponse(message=str(e))
+            return await collect_output(
+                process, input_bytes, timeout, expected_output=expected
+            )
 
-    seconds = 0
 
-    # Handle hours if present
-    if len(parts) == 3:
-        seconds += int(parts[0]) * 3600  # hours to seconds
-        parts = parts[1:]  # remove hours part
+def open_expected_output(stack: contextlib.ExitStack, expected_output):
+    if isinstance(expected_output, Blob):
+        # Stored with LF newlines already
+        return stack.enter_context(expected_output.mapped())
+    if expected_output is not None:
+        return expected_output.replace("\r\n", "\n").encode()
+
+
+def wall_time_limit(timeout) -> int:
+    # Time limits are on CPU time, wall time only guards against sleeping/blocked programs
+    return math.ceil(timeout * config.WALL_TIME_FACTOR)
+
+
+def spawn_sandbox(
+    command, tempdir, timeout=5, memory_limit=1000, idle_time=0, stdin=None, read_only=None
+):
+    # One extra second of CPU so a program over the limit is seen as such, not killed at it
+    cpu_limit = math.ceil(timeout) + 1
+    time_limit = wall_time_limit(timeout) + idle_time
+    nsjail_cmd = f"nsjail -Mo -q --user 99999 --group 99999 --rlimit_as {memory_limit} --rlimit_cpu {cpu_limit} --time_limit {time_limit} -R /bin/ -R /lib/ -R /lib64/ -R /usr/ -R /etc/alternatives/ -B {tempdir} -D {tempdir} --keep_env --".split()
+
+    # Extra read-only mounts go before the "--"
+    mounts = [arg for path in read_only or [] for arg in ("-R", path)]
+    peak_rss_pipe = None
+    helper = peak_rss_helper()
+    if helper:
+        # The helper runs the command and reports its peak memory on the pipe
+        peak_rss_pipe = os.pipe()
+        os.set_blocking(peak_rss_pipe[0], False)
+        write_fd = str(peak_rss_pipe[1])
+        mounts += ["-R", os.path.dirname(helper), "--pass_fd", write_fd]
+        command = [helper, write_fd, *command]
+    command = nsjail_cmd[:-1] + mounts + nsjail_cmd[-1:] + command
+    trace("Command: %s", command)
+
+    with stage_seconds.time("spawn"):
+        return SandboxProcess(command, stdin, peak_rss_pipe)
+
+
+async def collect_output(
+    process: SandboxProcess,
+    input_bytes,
+    timeout=5,
+    started_at=None,
+    expected_output=None,
+) -> RunResponse:
+    """Feed input to a sandboxed process and build its RunResponse.
+
+    Time comes from the process' rusage: elapsed_time is CPU time in seconds,
+    wall time is measured from started_at (defaults to the spawn). Memory is
+    the peak RSS the helper reported, None without it.
+    Output is compared to expected_output (a buffer with LF newlines) while it
+    streams in, only the first CAPTURE_BYTES of it are kept.
+    """
+    result = RunResponse(message="")
+    matcher = None
+    if expected_output is not None:
+        matcher = OutputMatcher(expected_output)
+    stdout = OutputCapture(config.CAPTURE_BYTES, config.OUTPUT_LIMIT_BYTES, matcher)
+    stderr = OutputCapture(config.CAPTURE_BYTES, config.OUTPUT_LIMIT_BYTES)
+    try:
+        try:
+            with stage_seconds.time("execute"):
+                await asyncio.wait_for(
+                    process.communicate(input_bytes, stdout, stderr),
+                    wall_time_limit(timeout),
+                )
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            result.timeout = True
+            return result
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+
+        trace("Stdout: %r", stdout.buffer)
+        trace("Stderr: %r", stderr.buffer)
+        if matcher:
+            # Compared while the output streamed in
+            stage_seconds.observe(matcher.elapsed, "compare")
+
+        usage = process.rusage
+        cpu_time = usage.ru_utime + usage.ru_stime
+        wall_time = process.exited_at - (started_at or process.started_at)
 
-    # Handle minutes
-    seconds += int(parts[0]) * 60  # minutes to seconds
+        if cpu_time > timeout or process.returncode == 137:
+            result.timeout = True
+
+        result.output_limit_exceeded = stdout.exceeded or stderr.exceeded
+        result.test_passed = matcher is not None and matcher.matched()
+        result.stdout = decode_output(stdout.buffer, stdout.truncated)
+        result.stderr = decode_output(stderr.buffer, stderr.truncated)
+        result.return_code = process.returncode
+        result.cpu_time_us = round(cpu_time * 1_000_000)
+        result.wall_time_us = round(wall_time * 1_000_000)
+        result.elapsed_time = round(cpu_time, 3)
+        if process.peak_rss is not None:
+            result.memory_usage = round(process.peak_rss / 1024, 3)  # in MB
+    except Exception as e:
+        traceback.print_exc()
+        result.message = str(e)
+
+    return result
 
-    # Handle seconds and milliseconds
-    if "." in parts[1]:
-        secs, msecs = parts[1].split(".")
-        seconds += int(secs)
-        seconds += int(msecs) / 100  # milliseconds to seconds
-    else:
-        seconds += int(parts[1])
 
-    return seconds
\ No newline at end of file
+async def spawn_warm_worker(language: Language) -> WarmWorker:
+    workspace = workspaces.lease()
+    try:
+        process = spawn_sandbox(
+            WARM_BOOTSTRAP[language.value],
+            workspace,
+            # Idle time in the pool must not count against the program
+            idle_time=config.WARM_POOL_MAX_IDLE,
+        )
+    except Exception:
+        workspaces.release(workspace)
+        raise
+    return WarmWorker(process, workspace)
+
+
+warm_pools = {}
+if config.WARM_POOL_SIZE > 0:
+    warm_pools = {
+        language: WarmPool(
+            functools.partial(spawn_warm_worker, language),
+            config.WARM_POOL_SIZE,
+            config.WARM_POOL_MAX_IDLE,
+        )
+        for language in (Language.PYTHON, Language.JAVASCRIPT)
+    }
+
+
+def decode_output(data: bytes, truncated: bool = False) -> str:
+    # Same newline handling as a text mode pipe
+    text = data.decode(errors="replace").replace("\r\n", "\n").replace("\r", "\n")
+    if truncated:
+        text += "\n... (output truncated)"
+    return text
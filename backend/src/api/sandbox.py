@@ -0,0 +1,403 @@
+import asyncio
+import fcntl
+import functools
+import hashlib
+import os
+import signal
+import subprocess
+import time
+
+from api import config
+
+# Started in the sandbox as the program's parent, writes the program's peak RSS
+# (in KB) to the file descriptor given as first argument once it exits. The
+# rusage of nsjail can't be used for memory: a forked process starts with the
+# peak RSS of its parent, so every run would report the size of the API process.
+PEAK_RSS_SOURCE = r"""
+#include <errno.h>
+#include <fcntl.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <sys/resource.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+int main(int argc, char **argv) {
+    int fd = atoi(argv[1]);
+    // Closed when the program starts, it can't write its own figure
+    fcntl(fd, F_SETFD, FD_CLOEXEC);
+    pid_t pid = fork();
+    if (pid == 0) {
+        execvp(argv[2], argv + 2);
+        perror(argv[2]);
+        _exit(127);
+    }
+    int status;
+    struct rusage usage;
+    while (wait4(pid, &status, 0, &usage) < 0) {
+        if (errno != EINTR)
+            return 127;
+    }
+    dprintf(fd, "%ld\n", usage.ru_maxrss);
+    // The exit code nsjail gives for a program killed by a signal
+    if (WIFSIGNALED(status))
+        return 128 + WTERMSIG(status);
+    return WEXITSTATUS(status);
+}
+"""
+
+
+@functools.cache
+def peak_rss_helper() -> str | None:
+    """Path of the peak RSS helper, built on first use (None if that failed)."""
+    digest = hashlib.sha256(PEAK_RSS_SOURCE.encode()).hexdigest()[:16]
+    path = os.path.abspath(os.path.join(config.SANDBOX_HELPER_DIR, digest, "peak_rss"))
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        subprocess.run(
+            ["/bin/gcc", "-O2", "-x", "c", "-", "-o", tmp_path],
+            input=PEAK_RSS_SOURCE.encode(),
+            capture_output=True,
+            check=True,
+            timeout=60,
+        )
+    except subprocess.CalledProcessError as e:
+        print("Building the peak RSS helper failed:", e.stderr.decode(errors="replace"))
+        return None
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print("Building the peak RSS helper failed:", e)
+        return None
+    os.replace(tmp_path, path)
+    return path
+
+
+class SandboxSlots:
+    """Limits the sandboxes running at once on the machine, over every process
+    (the API and the judge workers) sharing the directory.
+
+    A slot is an flock on one of `size` files, so the slots of a process that
+    dies are freed with it. Slots held by other processes are polled for, in
+    a process waiters queue on a semaphore first so only the next one polls.
+    """
+
+    POLL_MAX_DELAY = 0.02
+
+    def __init__(self, directory: str, size: int):
+        self.directory = directory
+        self.size = size
+        self.local = asyncio.BoundedSemaphore(size)
+        self.free: list[int] | None = None  # slot files this process doesn't hold
+        self.held: list[int] = []
+
+    async def __aenter__(self):
+        await self.local.acquire()
+        try:
+            if self.free is None:
+                self.free = self._open()
+            delay = 0.001
+            while not self._lock():
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.POLL_MAX_DELAY)
+        except BaseException:
+            self.local.release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        # Any held slot will do, they are all alike
+        fd = self.held.pop()
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        self.free.append(fd)
+        self.local.release()
+
+    def _open(self) -> list[int]:
+        os.makedirs(self.directory, exist_ok=True)
+        return [
+            os.open(os.path.join(self.directory, str(index)), os.O_RDWR | os.O_CREAT, 0o600)
+            for index in range(self.size)
+        ]
+
+    def _lock(self) -> bool:
+        for fd in self.free:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            self.free.remove(fd)
+            self.held.append(fd)
+            return True
+        return False
+
+
+class SandboxProcess:
+    """Child process that is reaped with wait4, so its resource usage is kept.
+
+    asyncio's subprocess support reaps children itself and throws the rusage
+    away, so exit is watched through a pidfd and the pipes are read directly.
+    """
+
+    def __init__(
+        self, command: list[str], stdin=None, peak_rss_pipe: tuple[int, int] | None = None
+    ):
+        """peak_rss_pipe is a pipe (read end non-blocking) the command reports
+        the program's peak RSS on, through the peak RSS helper. Its write end
+        is passed to the command and both ends are owned by this object."""
+        self._peak_rss_fd = None
+        pass_fds = ()
+        if peak_rss_pipe:
+            self._peak_rss_fd, write_fd = peak_rss_pipe
+            pass_fds = (write_fd,)
+        try:
+            # stdin is a pipe unless a file is given to read from
+            self.popen = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE if stdin is None else stdin,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                start_new_session=True,
+                pass_fds=pass_fds,
+            )
+        except BaseException:
+            if self._peak_rss_fd is not None:
+                os.close(self._peak_rss_fd)
+            raise
+        finally:
+            # Only the sandbox may hold it, the read end sees EOF once it is gone
+            for fd in pass_fds:
+                os.close(fd)
+        self.pid = self.popen.pid
+        self.started_at = time.perf_counter()
+        self.exited_at = None
+        self.returncode = None
+        self.rusage = None
+        self.peak_rss = None  # of the program in KB, see peak_rss_helper
+
+        for pipe in self._pipes():
+            os.set_blocking(pipe.fileno(), False)
+
+        self._loop = asyncio.get_running_loop()
+        self._exited = self._loop.create_future()
+        self._pidfd = os.pidfd_open(self.pid)
+        self._loop.add_reader(self._pidfd, self._reap)
+
+    def _reap(self):
+        self._loop.remove_reader(self._pidfd)
+        os.close(self._pidfd)
+        _, status, self.rusage = os.wait4(self.pid, 0)
+        self.exited_at = time.perf_counter()
+        self.returncode = os.waitstatus_to_exitcode(status)
+        self.peak_rss = self._read_peak_rss()
+        # Already reaped, Popen must not wait for it again
+        self.popen.returncode = self.returncode
+        self._exited.set_result(self.returncode)
+
+    def _read_peak_rss(self) -> int | None:
+        if self._peak_rss_fd is None:
+            return None
+        try:
+            # Written before the helper exited, nothing if it was killed
+            data = os.read(self._peak_rss_fd, 64)
+        except BlockingIOError:
+            data = b""
+        finally:
+            os.close(self._peak_rss_fd)
+            self._peak_rss_fd = None
+        return int(data) if data.strip().isdigit() else None
+
+    async def wait(self) -> int:
+        return await asyncio.shield(self._exited)
+
+    def kill(self):
+        # Kill the whole group so nothing is left holding the pipes
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _pipes(self):
+        return [
+            pipe
+            for pipe in (self.popen.stdin, self.popen.stdout, self.popen.stderr)
+            if pipe is not None
+        ]
+
+    async def communicate(
+        self,
+        input_bytes: bytes | list | None,
+        stdout: "OutputCapture",
+        stderr: "OutputCapture",
+    ):
+        """Feed stdin and stream stdout/stderr into the captures until exit.
+
+        input_bytes may be a list of buffers (bytes, mmap...) written in turn,
+        it is ignored when stdin was given a file. The process is killed as soon as a capture goes over its limit.
+        """
+        try:
+            await asyncio.gather(
+                self._write(input_bytes),
+                self._read(self.popen.stdout, stdout),
+                self._read(self.popen.stderr, stderr),
+            )
+            await self.wait()
+        finally:
+            self.close_pipes()
+
+    def close_pipes(self):
+        for pipe in self._pipes():
+            pipe.close()
+
+    async def _write(self, data: bytes | list | None):
+        if self.popen.stdin is None:
+            return
+        fd = self.popen.stdin.fileno()
+        try:
+            for buffer in data if isinstance(data, list) else [data or b""]:
+                # Slices are only held for the write, so a mapped buffer can be closed after
+                with memoryview(buffer) as view:
+                    offset = 0
+                    while offset < len(view):
+                        try:
+                            offset += os.write(fd, view[offset:])
+                        except BlockingIOError:
+                            await self._ready(fd, write=True)
+        except BrokenPipeError:
+            # Program exited without reading all of its input
+            pass
+        self.popen.stdin.close()
+
+    async def _read(self, pipe, capture: "OutputCapture"):
+        while True:
+            try:
+                chunk = os.read(pipe.fileno(), 65536)
+            except BlockingIOError:
+                await self._ready(pipe.fileno())
+                continue
+            if not chunk:
+                return
+            if not capture.feed(chunk):
+                self.kill()
+                return
+
+    async def _ready(self, fd: int, write: bool = False):
+        future = self._loop.create_future()
+        if write:
+            add, remove = self._loop.add_writer, self._loop.remove_writer
+        else:
+            add, remove = self._loop.add_reader, self._loop.remove_reader
+        add(fd, lambda: future.done() or future.set_result(None))
+        try:
+            await future
+        finally:
+            remove(fd)
+
+
+class OutputCapture:
+    """Consumes a stream keeping only its first `keep` bytes.
+
+    Everything is counted against `limit`, and passed on to an OutputMatcher if
+    one is given, so the full output never has to be held in memory.
+    """
+
+    def __init__(self, keep: int, limit: int, matcher: "OutputMatcher | None" = None):
+        self.keep = keep
+        self.limit = limit
+        self.matcher = matcher
+        self.buffer = bytearray()
+        self.size = 0
+        self.exceeded = False
+
+    def feed(self, chunk: bytes) -> bool:
+        """Returns False once the stream went over its limit."""
+        self.size += len(chunk)
+        if self.size > self.limit:
+            self.exceeded = True
+            return False
+        if len(self.buffer) < self.keep:
+            self.buffer += chunk[: self.keep - len(self.buffer)]
+        if self.matcher:
+            started = time.perf_counter()
+            self.matcher.feed(chunk)
+            self.matcher.elapsed += time.perf_counter() - started
+        return True
+
+    @property
+    def truncated(self) -> bool:
+        return self.size > len(self.buffer)
+
+
+class OutputMatcher:
+    """Incrementally checks a stream against an expected output.
+
+    Same result as comparing both with newlines and surrounding spaces stripped,
+    without buffering the output. The expected output must already use LF
+    newlines, it can be any buffer supporting slicing (e.g. an mmap) and is
+    never copied as a whole.
+    """
+
+    WHITESPACE = b"\n "
+
+    def __init__(self, expected):
+        self.expected = expected
+        # Bounds of expected without surrounding whitespace
+        self.start = 0
+        self.end = len(expected)
+        while self.start < self.end and expected[self.start] in self.WHITESPACE:
+            self.start += 1
+        while self.end > self.start and expected[self.end - 1] in self.WHITESPACE:
+            self.end -= 1
+        self.pos = 0  # matched prefix of expected
+        self.started = False
+        self.ok = True
+        # Whitespace seen but not yet known to be trailing
+        self.pending = 0
+        self.pending_ok = True
+        self.carriage_return = False
+        self.elapsed = 0.0  # seconds spent comparing, see OutputCapture.feed
+
+    def feed(self, chunk: bytes):
+        if not self.ok:
+            return
+        # Normalize CRLF and CR to LF, a CR may end one chunk and its LF start the next
+        if self.carriage_return:
+            chunk = b"\r" + chunk
+        self.carriage_return = chunk.endswith(b"\r")
+        if self.carriage_return:
+            chunk = chunk[:-1]
+        chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        self._feed(chunk)
+
+    def _feed(self, chunk: bytes):
+        if not self.started:
+            chunk = chunk.lstrip(self.WHITESPACE)
+            if not chunk:
+                return
+            self.started = True
+
+        content = chunk.rstrip(self.WHITESPACE)
+        if content:
+            start = self.pos + self.pending
+            end = start + len(content)
+            self.ok = self.pending_ok and self._expected(start, end) == content
+            self.pos = end
+            self.pending = 0
+            self.pending_ok = True
+            chunk = chunk[len(content) :]
+
+        if chunk:
+            start = self.pos + self.pending
+            end = start + len(chunk)
+            self.pending_ok = self.pending_ok and self._expected(start, end) == chunk
+            self.pending = end - self.pos
+
+    def _expected(self, start: int, end: int) -> bytes:
+        # Offsets into the stripped expected output, clamped to it like a slice
+        length = self.end - self.start
+        return self.expected[self.start + min(start, length) : self.start + min(end, length)]
+
+    def matched(self) -> bool:
+        if self.carriage_return:
+            self.carriage_return = False
+            self._feed(b"\n")
+        return self.ok and self.pos == self.end - self.start
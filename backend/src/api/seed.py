@@ -0,0 +1,40 @@
+"""Set up and seed the database ahead of time, or build a snapshot of it:
+
+    python -m api.seed
+    python -m api.seed --snapshot seed.db
+
+Point CODEFORGE_DB_SNAPSHOT at the snapshot and new SQLite databases are copied
+from it instead of being seeded. Testcase data lives in CODEFORGE_TESTDATA_DIR,
+not in the snapshot, so build it with the same testdata directory.
+"""
+
+import argparse
+import asyncio
+import os
+
+from api import config, models
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Set up the CodeForge database")
+    parser.add_argument("--snapshot", help="build a seeded SQLite database at this path")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        for path in (args.snapshot, f"{args.snapshot}-wal", f"{args.snapshot}-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        config.DATABASE_URL = f"sqlite+aiosqlite:///{args.snapshot}"
+        config.DB_SNAPSHOT = None
+
+    await models.init_db()
+    if args.snapshot:
+        # Fold the WAL back in, the snapshot must be a single file
+        async with models.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    await models.close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,108 @@
+import asyncio
+import time
+import traceback
+from collections import deque
+
+from api.sandbox import SandboxProcess
+from api.workspace import workspaces
+
+# Started inside the sandbox ahead of time. Each waits for a single line naming
+# the file to run, then runs it exactly like `python3 main.py` / `node main.js`
+# would. stdin is read byte by byte so none of the program's input is consumed.
+PYTHON_BOOTSTRAP = """
+import os, runpy, sys
+line = b""
+while not line.endswith(b"\\n"):
+    char = os.read(0, 1)
+    if not char:
+        sys.exit(0)
+    line += char
+sys.argv = [line.decode().strip()]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+NODE_BOOTSTRAP = """
+const fs = require("fs");
+const char = Buffer.alloc(1);
+let line = "";
+while (!line.endsWith("\\n")) {
+  if (fs.readSync(0, char, 0, 1) === 0) process.exit(0);
+  line += char.toString();
+}
+process.argv[1] = require("path").resolve(line.trim());
+require("module").runMain();
+"""
+
+WARM_BOOTSTRAP = {
+    "py": ["/bin/python3", "-c", PYTHON_BOOTSTRAP],
+    "js": ["/bin/node", "-e", NODE_BOOTSTRAP],
+}
+
+
+class WarmWorker:
+    def __init__(self, process: SandboxProcess, workspace: str):
+        self.process = process
+        self.workspace = workspace
+        self.started_at = time.monotonic()
+
+    async def release(self):
+        if self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        self.process.close_pipes()
+        workspaces.release(self.workspace)
+
+
+class WarmPool:
+    """Pre-started sandboxed interpreters for one language.
+
+    A worker runs a single program and is then thrown away, so runs stay as
+    isolated as a cold start. The pool is topped up in the background.
+    """
+
+    def __init__(self, spawn, size: int, max_idle: float):
+        self.spawn = spawn
+        self.size = size
+        self.max_idle = max_idle
+        self.idle: deque[WarmWorker] = deque()
+        self.spawning = 0
+        self.pending: set[asyncio.Task] = set()
+
+    async def acquire(self) -> WarmWorker:
+        worker = None
+        while self.idle and worker is None:
+            candidate = self.idle.popleft()
+            expired = time.monotonic() - candidate.started_at > self.max_idle
+            if expired or candidate.process.returncode is not None:
+                self._start(candidate.release())
+            else:
+                worker = candidate
+        self.refill()
+
+        if worker is None:
+            worker = await self.spawn()
+        return worker
+
+    def refill(self):
+        for _ in range(self.size - len(self.idle) - self.spawning):
+            self.spawning += 1
+            self._start(self._add_worker())
+
+    async def _add_worker(self):
+        try:
+            self.idle.append(await self.spawn())
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.spawning -= 1
+
+    async def close(self):
+        self.size = 0
+        while self.idle:
+            await self.idle.popleft().release()
+
+    def _start(self, coro):
+        # Keep a reference until done, the loop only holds weak ones
+        task = asyncio.create_task(coro)
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
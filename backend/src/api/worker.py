@@ -0,0 +1,211 @@
+"""Judge worker processes.
+
+Workers take queued submissions from the Jobs table, judge them and store the
+result. Every finished test, the end of the job and solved submissions are
+published on the backplane (see api.backplane), for the API processes' job
+streams and leaderboards. Run them next to the API with CODEFORGE_JUDGE_WORKERS, or on their own
+(any number of machines sharing the database) with:
+
+    python -m api.worker --processes 4
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import traceback
+
+from api import config, metrics
+from api.backplane import backplane
+from api.judge import judge_submission
+from api.metrics import stage_seconds
+from api.models import Jobs, Problems, close_db
+from api.routes.run import RunRequest, build_precompiled_headers, close_warm_pools
+
+# Seconds between checks for crashed workers, also the least time between restarts
+WORKER_CHECK_INTERVAL = 1
+# Output of each stream sent with a test's live result, so the message fits in
+# a datagram of the socket backplane. The job's result keeps all of it
+LIVE_OUTPUT_CHARS = 4096
+
+
+async def run_job(job: Jobs):
+    progress = {}
+    changed = asyncio.Event()
+    # Published in order by publish_progress, judging doesn't wait for it
+    messages = asyncio.Queue()
+    messages.put_nowait({"type": "job_claimed", "job_id": job.id})
+
+    def on_result(index, result):
+        progress[index] = result.model_dump()
+        changed.set()
+        live_result = {
+            **progress[index],
+            "stdout": result.stdout[:LIVE_OUTPUT_CHARS],
+            "stderr": result.stderr[:LIVE_OUTPUT_CHARS],
+        }
+        messages.put_nowait(
+            {"type": "job_test", "job_id": job.id, "index": index, "result": live_result}
+        )
+
+    async def publish_progress():
+        while True:
+            message = await messages.get()
+            try:
+                await backplane.publish(message)
+            except Exception as e:
+                # Streams find the test in the job's result
+                print(f"Publishing progress of job {job.id} failed:", e)
+
+    async def heartbeat():
+        # Also publishes partial results, so clients can stream them
+        while True:
+            try:
+                await asyncio.wait_for(changed.wait(), config.JOB_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            changed.clear()
+            try:
+                await job.save_progress(json.dumps(progress) if progress else None)
+            except Exception as e:
+                # Tried again on the next change or heartbeat
+                print(f"Saving progress of job {job.id} failed:", e)
+            await asyncio.sleep(config.JOB_PROGRESS_INTERVAL)
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    publish_task = asyncio.create_task(publish_progress())
+    try:
+        problem = await Problems.get_by_id(job.problem_id)
+        run_req = RunRequest.model_validate_json(job.request)
+        result = await judge_submission(problem, run_req, job.fail_fast, on_result)
+    except asyncio.CancelledError:
+        await job.requeue()
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        await job.finish("failed", json.dumps({"error": str(e)}))
+        await publish_finished(job)
+    else:
+        with stage_seconds.time("job_finish"):
+            await job.finish("done", result.model_dump_json())
+        await publish_finished(job)
+        if result.is_solved:
+            await publish_solved(job)
+    finally:
+        heartbeat_task.cancel()
+        publish_task.cancel()
+
+
+async def publish_finished(job: Jobs):
+    """Let the job's streams send the result, which they read from the database."""
+    try:
+        await backplane.publish({"type": "job_finished", "job_id": job.id})
+    except Exception as e:
+        print(f"Publishing the end of job {job.id} failed:", e)
+
+
+async def publish_solved(job: Jobs):
+    """Let the API processes update their leaderboards and solved problems."""
+    try:
+        with stage_seconds.time("publish"):
+            await backplane.publish({
+                "type": "solved",
+                "problem_id": job.problem_id,
+                "contest_id": job.contest_id,
+                "username": job.username,
+            })
+    except Exception as e:
+        print("Publishing solved submission failed:", e)
+
+
+async def work(name: str):
+    print(f"Judge worker {name} started")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    if config.TRACE:
+        metrics.set_tracing(True)
+    metrics_task = asyncio.create_task(metrics.write_snapshots())
+    build_precompiled_headers()
+
+    running = set()
+    last_cleanup = 0
+    poll_interval = config.JOB_POLL_INTERVAL
+    while not stop.is_set():
+        try:
+            if time.monotonic() - last_cleanup > config.JOB_STALE_SECONDS / 2:
+                await Jobs.requeue_stale(config.JOB_STALE_SECONDS)
+                await Jobs.prune(config.JOB_RETENTION_SECONDS)
+                last_cleanup = time.monotonic()
+            while len(running) < config.JOBS_PER_WORKER and (job := await Jobs.claim(name)):
+                task = asyncio.create_task(run_job(job))
+                running.add(task)
+                task.add_done_callback(running.discard)
+            poll_interval = config.JOB_POLL_INTERVAL
+        except Exception as e:
+            # e.g. the database is locked or unreachable, back off until it is back
+            print(f"Judge worker {name} failed to poll the queue:", e)
+            poll_interval = min(poll_interval * 2, config.JOB_POLL_MAX_INTERVAL)
+        try:
+            await asyncio.wait_for(stop.wait(), poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    # Unfinished jobs go back to the queue for another worker
+    for task in running:
+        task.cancel()
+    await asyncio.gather(*running, return_exceptions=True)
+    metrics_task.cancel()
+    await close_warm_pools()
+    await backplane.close()
+    await close_db()
+
+
+def run_worker(index: int):
+    asyncio.run(work(f"{socket.gethostname()}-{os.getpid()}-{index}"))
+
+
+def start_worker(index: int) -> multiprocessing.Process:
+    # spawn, not fork: the parent may be in the middle of an event loop
+    context = multiprocessing.get_context("spawn")
+    process = context.Process(target=run_worker, args=(index,), daemon=True)
+    process.start()
+    return process
+
+
+def start_workers(count: int) -> list[multiprocessing.Process]:
+    return [start_worker(index) for index in range(count)]
+
+
+def restart_crashed(processes: list[multiprocessing.Process]):
+    """Start again the workers that died, a stopped worker exits with 0."""
+    for index, process in enumerate(processes):
+        if process.exitcode not in (None, 0):
+            print(f"Judge worker {index} exited with {process.exitcode}, restarting it")
+            processes[index] = start_worker(index)
+
+
+async def supervise_workers(processes: list[multiprocessing.Process]):
+    while True:
+        await asyncio.sleep(WORKER_CHECK_INTERVAL)
+        restart_crashed(processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run CodeForge judge workers")
+    parser.add_argument("--processes", type=int, default=1)
+    args = parser.parse_args()
+
+    processes = start_workers(args.processes)
+    while any(process.exitcode != 0 for process in processes):
+        time.sleep(WORKER_CHECK_INTERVAL)
+        restart_crashed(processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import atexit
+import os
+import shutil
+from collections import deque
+
+from api import config
+
+
+class WorkspacePool:
+    """Scratch directories for sandboxes, created up front and wiped and
+    reused instead of created per run.
+
+    Every process gets its own directory under root, directories left behind
+    by processes that are gone are removed on start.
+    """
+
+    def __init__(self, root: str, size: int):
+        self.size = size
+        self.directory = os.path.join(root, f"codeforge_{os.getpid()}")
+        self.free: deque[str] = deque()
+        self.created = 0
+
+        os.makedirs(root, exist_ok=True)
+        if os.statvfs(root).f_flag & os.ST_NOEXEC:
+            raise ValueError(f"Binaries can't run from {root}, it is mounted noexec")
+        remove_stale(root)
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        for _ in range(size):
+            self.free.append(self._create())
+        atexit.register(self.close)
+
+    def lease(self) -> str:
+        if self.free:
+            return self.free.popleft()
+        # More concurrent runs than pooled workspaces, grow and shrink back on release
+        return self._create()
+
+    def release(self, path: str):
+        try:
+            wipe(path)
+        except OSError:
+            shutil.rmtree(path, ignore_errors=True)
+            return
+        if len(self.free) < self.size:
+            self.free.append(path)
+        else:
+            os.rmdir(path)
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _create(self) -> str:
+        self.created += 1
+        path = os.path.join(self.directory, str(self.created))
+        os.mkdir(path, mode=0o700)
+        return path
+
+
+def wipe(path: str):
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+
+
+def remove_stale(root: str):
+    for entry in os.scandir(root):
+        if not entry.name.startswith("codeforge_"):
+            continue
+        pid = entry.name.removeprefix("codeforge_")
+        if pid.isdigit() and not os.path.exists(f"/proc/{pid}"):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+workspaces = WorkspacePool(config.WORKSPACE_ROOT, config.WORKSPACE_POOL_SIZE)
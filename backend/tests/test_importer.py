@@ -0,0 +1,56 @@
+import io
+import json
+import random
+
+import pytest
+
+from api.importer import iter_json_array
+
+DOCUMENTS = [
+    "[]",
+    " [ ] ",
+    "[-2500.0]",
+    "[1e5, 1E-5, -0.5e+10, 2.25E+3]",
+    "[0, -0, 12, 3.0, -2500.125]",
+    '[1, "two", true, false, null, 3.5]',
+    '[{"a": [1, 2.5, {"b": -3e2}]}, [], {}, [[-1.0]]]',
+    '["chunk \\"boundary\\" \\u00e9 \\n", "]", ","]',
+    '\n[\n  {"title": "Two Sum", "testcases": [{"input": "4\\n2 7", "output": "0 1"}]},\n  7\n]\n',
+]
+
+
+def random_value(rng: random.Random, depth: int = 0):
+    kind = rng.randrange(7 if depth < 3 else 4)
+    if kind == 0:
+        return rng.randint(-10**6, 10**6)
+    if kind == 1:
+        return rng.choice([-2500.0, 0.5, 1e21, -1.5e-7, rng.uniform(-1e6, 1e6)])
+    if kind == 2:
+        return "".join(rng.choice('ab ,]"\\é\n1e.') for _ in range(rng.randrange(6)))
+    if kind == 3:
+        return rng.choice([True, False, None])
+    if kind in (4, 5):
+        return [random_value(rng, depth + 1) for _ in range(rng.randrange(4))]
+    return {f"k{i}": random_value(rng, depth + 1) for i in range(rng.randrange(3))}
+
+
+def random_documents(count: int):
+    rng = random.Random(0)
+    for _ in range(count):
+        items = [random_value(rng) for _ in range(rng.randrange(5))]
+        yield json.dumps(items, indent=rng.choice([None, 1]))
+
+
+@pytest.mark.parametrize("document", DOCUMENTS + list(random_documents(50)))
+def test_every_chunk_size_matches_json_loads(document):
+    expected = json.loads(document)
+    for chunk_size in range(1, len(document) + 2):
+        items = list(iter_json_array(io.StringIO(document), chunk_size))
+        assert items == expected, f"chunk_size={chunk_size}"
+
+
+@pytest.mark.parametrize("document", ["{}", "[1 2]", "[1,", "[-]"])
+def test_invalid_documents_raise(document):
+    for chunk_size in range(1, len(document) + 2):
+        with pytest.raises(ValueError):
+            list(iter_json_array(io.StringIO(document), chunk_size))
@@ -19,6 +19,7 @@ import {
 
 // Define the type for leaderboard entries
 interface LeaderboardEntry {
+  rank: number;
   username: string;
   solved_problems: number;
   total_time: string;
@@ -28,6 +29,33 @@ interface LeaderboardProps {
   contest_code: string;
 }
 
+// Replace the changed users' rows, then re-sort and re-rank, ties share a rank
+const mergeStandings = (
+  current: LeaderboardEntry[],
+  rows: LeaderboardEntry[]
+): LeaderboardEntry[] => {
+  const byUsername = new Map(current.map((entry) => [entry.username, entry]));
+  rows.forEach((row) => byUsername.set(row.username, row));
+  const merged = Array.from(byUsername.values()).sort(
+    (a, b) =>
+      b.solved_problems - a.solved_problems ||
+      Number(a.total_time) - Number(b.total_time) ||
+      a.username.localeCompare(b.username)
+  );
+  let rank = 0;
+  return merged.map((entry, index) => {
+    const previous = merged[index - 1];
+    if (
+      !previous ||
+      previous.solved_problems !== entry.solved_problems ||
+      Number(previous.total_time) !== Number(entry.total_time)
+    ) {
+      rank = index + 1;
+    }
+    return { ...entry, rank };
+  });
+};
+
 const Leaderboard: React.FC<LeaderboardProps> = ({ contest_code }) => {
   const [leaderboard, setLeaderboard] = useState<LeaderboardEntry[]>([]);
   const [error, setError] = useState<string | null>(null);
@@ -51,18 +79,10 @@ const Leaderboard: React.FC<LeaderboardProps> = ({ contest_code }) => {
     const ws = new WebSocket(`ws://localhost:8000/contests/ws/${contest_code}`);
 
     ws.onmessage = (event) => {
-      if (event.data === "reload") {
-        const fetchLeaderboard = async () => {
-          try {
-            const response = await axiosInstance.get(`/contests/${contest_code}/leaderboard`);
-            console.log(response.data);
-            setLeaderboard(response.data);
-          } catch (err) {
-            setError("Failed to fetch leaderboard.");
-          }
-        };
-
-        fetchLeaderboard();
+      // Only the rows that changed, merged into the ones we have
+      const update = JSON.parse(event.data);
+      if (update.type === "standings") {
+        setLeaderboard((current) => mergeStandings(current, update.rows));
       }
     };
 
@@ -93,9 +113,9 @@ const Leaderboard: React.FC<LeaderboardProps> = ({ contest_code }) => {
               </TableRow>
             </TableHeader>
             <TableBody>
-              {leaderboard.map((entry, index) => (
-                <TableRow key={index}>
-                  <TableCell className="text-left">{index + 1}</TableCell>
+              {leaderboard.map((entry) => (
+                <TableRow key={entry.username}>
+                  <TableCell className="text-left">{entry.rank}</TableCell>
                   <TableCell className="text-center">{entry.username}</TableCell>
                   <TableCell className="text-center">{entry.solved_problems}</TableCell>
                   <TableCell className="text-right">{entry.total_time}</TableCell>
@@ -197,7 +197,8 @@ const InputOutput: React.FC<InputOutputProps> = ({
     setShowSubmitSpinner(true);
 
     try {
-      const response = await axiosInstance.post(
+      // The submission is queued, poll the job until a judge worker is done with it
+      let { data: job } = await axiosInstance.post(
         `/problems/${problem_id}/submit`,
         {
           source_code: code,
@@ -205,15 +206,23 @@ const InputOutput: React.FC<InputOutputProps> = ({
           username: sessionStorage.getItem("username"),
         }
       );
-      setSubResponse(response.data);
+      while (job.status === "queued" || job.status === "running") {
+        await new Promise((resolve) => setTimeout(resolve, 500));
+        ({ data: job } = await axiosInstance.get(`/jobs/${job.id}`));
+      }
+      if (job.status !== "done") {
+        throw new Error(job.error);
+      }
+      const result = job.result;
+      setSubResponse(result);
       for (let i = 0; i < problem.examples.length - 1; i++) {
         const runText =
-          response.data?.results[i]?.stdout +
-            response.data?.results[i]?.stderr || "No output";
+          result?.results[i]?.stdout + result?.results[i]?.stderr ||
+          "No output";
 
-        const elapsedTime = response.data?.results[i]?.elapsed_time ?? "N/A";
-        const memoryUsage = response.data?.results[i]?.memory_usage ?? "N/A";
-        const message = response.data?.results[i]?.message ?? "N/A";
+        const elapsedTime = result?.results[i]?.elapsed_time ?? "N/A";
+        const memoryUsage = result?.results[i]?.memory_usage ?? "N/A";
+        const message = result?.results[i]?.message ?? "N/A";
 
         handleRunTextChange(String(i + 1), runText);
         handleElapsedTimeChange(String(i + 1), elapsedTime);